@@ -6,12 +6,31 @@
 from battery import Battery, Cell
 
 # from batters import Protection
-from utils import logger, read_serial_data
-from struct import unpack_from
-from time import sleep
+from utils import logger
+from struct import Struct, pack, unpack_from
+from functools import lru_cache
+from math import ceil
+from bisect import bisect_left
+from heapq import heappush, heappop
+from time import sleep, monotonic, time
 from pprint import pformat
+from array import array
+from math import nan, isnan
+import serial
 import utils
+import threading
+import mmap
+import json
 import sys
+import os
+import logging
+import socket
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 #    Author: Pfitz /
 #    Date: 01 Aug 2024
@@ -43,8 +62,1704 @@ import sys
 # The master unit or first unit should have a Dip Switch ID set to 16
 # All other BMS should have a Dip switch setting of 1 - 15
 
+# Modbus RTU reply framing: address, function, byte count, data..., CRC16
+FRAME_HEADER_LENGTH = 3
+FRAME_CRC_LENGTH = 2
+# Exception reply: address, function | 0x80, exception code, CRC16
+FRAME_EXCEPTION_LENGTH = 5
+
+MODBUS_READ_HOLDING = 0x03
+MODBUS_WRITE_SINGLE = 0x06
+MODBUS_WRITE_MULTIPLE = 0x10
+WRITE_FUNCTIONS = (MODBUS_WRITE_SINGLE, MODBUS_WRITE_MULTIPLE)
+# Write replies echo register and value / count instead of a byte count: 3 bytes after address and function
+WRITE_REPLY_DATA_LENGTH = 3
+WRITE_BATCH_MAX = 123  # Registers in one 0x10 request
+
+# Holding register blocks read from every BMS: (start register, register count)
+REGISTERS = {
+    "HW" : (0x0069, 0x17),
+    "CELL" : (0x0000, 0x27),
+    "CONFIG" : (0x002D, 0x5B),
+    "FAST" : (0x0000, 0x12),  # Head of the CELL block: pack voltage, current and the 16 cell voltages
+}
+# Blocks fetched together by a single wide read
+WIDE_BLOCKS = ("HW", "CELL")
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16_modbus(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def crc_valid(frame):
+    # The CRC is sent low byte first
+    if len(frame) < FRAME_CRC_LENGTH + 1:
+        return False
+    return crc16_modbus(frame[:-FRAME_CRC_LENGTH]) == (frame[-2] | (frame[-1] << 8))
+
+
+@lru_cache(maxsize=256)
+def build_command(slave_id, function, start, count):
+    frame = pack(">BBHH", slave_id, function, start, count)
+    return frame + pack("<H", crc16_modbus(frame))
+
+
+def build_write_command(slave_id, start, values):
+    # 0x06 for a single register, 0x10 for a run of consecutive registers
+    if len(values) == 1:
+        frame = pack(">BBHH", slave_id, MODBUS_WRITE_SINGLE, start, values[0])
+    else:
+        frame = pack(f">BBHHB{len(values)}H", slave_id, MODBUS_WRITE_MULTIPLE, start, len(values), len(values) * 2, *values)
+    return frame + pack("<H", crc16_modbus(frame))
+
+
+def register_span(names):
+    # Smallest contiguous (start, count) block covering all the named register blocks
+    start = min(REGISTERS[name][0] for name in names)
+    end = max(REGISTERS[name][0] + REGISTERS[name][1] for name in names)
+    return start, end - start
+
+
+def split_frame(frame, span_start, name):
+    # Cut one named register block out of a wide reply, returned as if it had been read on its own
+    start, count = REGISTERS[name]
+    offset = FRAME_HEADER_LENGTH + (start - span_start) * 2
+    return bytes((frame[0], frame[1], count * 2)) + frame[offset:offset + count * 2]
+
+
+def build_commands(bmsIds):
+    commands = {}
+    for bmsId in bmsIds:
+        commands[bmsId] = {}
+        for name, (start, count) in REGISTERS.items():
+            commands[bmsId][name] = build_command(bmsId, MODBUS_READ_HOLDING, start, count)
+        commands[bmsId]["WIDE"] = build_command(bmsId, MODBUS_READ_HOLDING, *register_span(WIDE_BLOCKS))
+    return commands
+
+
+# CELL reply (0x0000, 0x27 registers), decoded in one pass from the first data byte
+CELL_FRAME = Struct(">Hh16Hh4xHHHHBBHHHIIbb4xH")
+CELL_FRAME_OFFSET = FRAME_HEADER_LENGTH
+CELL_SLOTS = 16
+FAST_FRAME = Struct(">Hh16H")
+FAST_FRAME_FIELDS = 2 + CELL_SLOTS  # voltage, current and the cells, the leading CELL_FRAME fields
+
+
+class PackSnapshot:
+    # One decoded CELL frame plus the HW identity of the pack it came from
+
+    __slots__ = (
+        "voltage", "current", "capacity_remain", "capacity", "max_battery_charge_current",
+        "soc", "soh", "cycles", "temp1", "temp2", "temp_mos", "temp_max", "temp_min",
+        "cell_count", "cells", "cell_voltage", "cell_max", "cell_min",
+        "status_hex", "warning_hex", "protection_hex", "error_hex", "heater_status",
+        "balancing_code", "balancing_text", "hw_make", "hw_version", "hw_serial",
+        "timestamp", "fingerprint", "slow_fingerprint",
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.timestamp = monotonic()
+
+    def copy(self):
+        battery = PackSnapshot()
+        for name in self.__slots__:
+            setattr(battery, name, getattr(self, name))
+        return battery
+
+    def age(self, now=None):
+        if now is None:
+            now = monotonic()
+        return now - self.timestamp
+
+    def update_hw(self, hw):
+        # hw is either the dict from read_hw_details or an older snapshot
+        if isinstance(hw, PackSnapshot):
+            self.hw_make = hw.hw_make
+            self.hw_version = hw.hw_version
+            self.hw_serial = hw.hw_serial
+        else:
+            self.hw_make = hw["hw_make"]
+            self.hw_version = hw["hw_version"]
+            self.hw_serial = hw["hw_serial"]
+        return self
+
+
+# PackSnapshot fields kept in the warm start state file, the rest is derived again on load
+STATE_FIELDS = tuple(
+    name for name in PackSnapshot.__slots__
+    if name not in ("timestamp", "fingerprint", "slow_fingerprint", "balancing_code", "balancing_text")
+)
+STATE_LOCK = threading.Lock()  # Buses in multi-bus mode share the state and topology files
+FAST_FIELDS = ("voltage", "current", "cells")  # What a FAST frame refreshes
+
+
+def snapshot_state(snapshot):
+    state = {name : getattr(snapshot, name) for name in STATE_FIELDS}
+    state["cells"] = list(snapshot.cells)
+    return state
+
+
+def snapshot_from_state(state, age):
+    battery = PackSnapshot()
+    for name in STATE_FIELDS:
+        setattr(battery, name, state[name])
+    battery.cells = tuple(battery.cells)
+    battery.timestamp = monotonic() - age
+    battery.slow_fingerprint = hash(tuple(getattr(battery, name) for name in STATE_FIELDS if name not in FAST_FIELDS))
+    battery.fingerprint = hash((battery.slow_fingerprint, battery.voltage, battery.current, battery.cells))
+    return battery
+
+
+# Alarm registers are bit masks, one entry per bit: (text, alarm attribute set on the battery or None)
+WARNING_BITS = {
+    0x0001 : ("Pack Over Voltage", "voltage_high"),
+    0x0002 : ("Cell Over Voltage", "voltage_cell_high"),
+    0x0004 : ("Pack Under Voltage", "voltage_low"),
+    0x0008 : ("Cell Under Voltage", "voltage_cell_low"),
+    0x0010 : ("Charge Over Current", "current_over"),
+    0x0020 : ("Discharge Over Current", "current_over"),
+    0x0040 : ("Ambient High Temp", "temp_high_internal"),
+    0x0080 : ("Mosfets High Temp", "temp_high_internal"),
+    0x0100 : ("Charge Over Temp", "temp_high_charge"),
+    0x0200 : ("Discharge Over Temp", "temp_high_discharge"),
+    0x0400 : ("Charge Under Temp", "temp_low_charge"),
+    0x1000 : ("Low Capacity", "soc_low"),
+    0x2000 : ("Float Stoped", None),
+    0x4000 : ("UNKNOWN", "internal_failure"),
+}
+PROTECTION_BITS = {
+    0x0001 : ("Pack Over Voltage", "voltage_high"),
+    0x0002 : ("Cell Over Voltage", "voltage_cell_high"),
+    0x0004 : ("Pack Under Voltage", "voltage_low"),
+    0x0008 : ("Cell Under Voltage", "voltage_cell_low"),
+    0x0010 : ("Charge Over Current", "current_over"),
+    0x0020 : ("Discharge Over Current", "current_over"),
+    0x0040 : ("High Ambient Temp", "temp_high_internal"),
+    0x0080 : ("Mosfets High Temp", "temp_high_internal"),
+    0x0100 : ("Charge Over Temp", "temp_high_charge"),
+    0x0200 : ("Discharge Over Temp", "temp_high_discharge"),
+    0x0400 : ("Charge Under Temp", "temp_low_charge"),
+    0x0800 : ("Discharge Under Temp", "temp_low_charge"),
+    0x1000 : ("Low Capacity", "soc_low"),
+    0x2000 : ("Discharge SC", None),
+}
+ERROR_BITS = {
+    0x0001 : ("Voltage Error", None),
+    0x0002 : ("Temperature Error", None),
+    0x0004 : ("Current Flow Error", None),
+    0x0010 : ("Cell Unbalanced", None),
+}
+
+
+def _alarm_masks(bits):
+    # Alarm attribute -> mask of every bit that raises it
+    masks = {}
+    for bit, (text, attribute) in bits.items():
+        if attribute is not None:
+            masks[attribute] = masks.get(attribute, 0) | bit
+    return masks
+
+
+WARNING_MASKS = _alarm_masks(WARNING_BITS)
+PROTECTION_MASKS = _alarm_masks(PROTECTION_BITS)
+ALARM_ATTRIBUTES = tuple(sorted(set(WARNING_MASKS) | set(PROTECTION_MASKS)))
+
+
+def alarm_text(mask, bits, label, none_text):
+    # Only used when something is logged, the poll loop works on the masks
+    if mask == 0:
+        return f"{none_text} - 0000"
+    parts = []
+    while mask:
+        bit = mask & -mask
+        mask ^= bit
+        text = bits[bit][0] if bit in bits else "UNKNOWN"
+        parts.append(f"{label}: {bit:04X} - {text}")
+    return " | ".join(parts)
+
+
+BANK_PACKS = 16
+
+
+class BankArrays:
+    # Latest values of every pack on the chain in preallocated flat arrays,
+    # row = BMS ID - 1, updated in place on every rollup. Missing packs and
+    # unused cell slots hold NaN.
+    # Sums are maintained incrementally: a changed pack subtracts its old
+    # contribution and adds the new one, a pack whose snapshot fingerprint did
+    # not change is skipped. Maxima / minima and the alarm union are only
+    # recomputed when something changed, with NumPy views over the same
+    # memory when NumPy is installed.
+
+    PACK_FIELDS = ("cell_voltage", "current", "soc", "soh", "capacity", "capacity_remain",
+                   "cycles", "temp1", "temp2", "temp_mos")
+    SUMS = ("cell_voltage", "current", "capacity", "capacity_remain", "soc", "soh",
+            "soc_weighted", "soh_weighted", "packs")
+    RESUM_AFTER = 1000  # Incremental updates before the sums are rebuilt to shed float drift
+
+    def __init__(self, packs=BANK_PACKS, slots=CELL_SLOTS):
+        self.packs = packs
+        self.slots = slots
+        self.cells = array("d", [nan]) * (packs * slots)
+        self.fields = {name : array("d", [nan]) * packs for name in self.PACK_FIELDS}
+        self.alarms = [(0, 0, 0)] * packs
+        self.fingerprints = [None] * packs
+        self.present = set()
+        self.sums = dict.fromkeys(self.SUMS, 0.0)
+        self.updates = 0
+        self.dirty = True
+        self.generation = 0
+        self.result = None
+        if np is not None:
+            self.cells_np = np.frombuffer(self.cells, dtype=np.float64)
+            self.fields_np = {name : np.frombuffer(values, dtype=np.float64) for name, values in self.fields.items()}
+
+    def contribute(self, row, sign):
+        fields = self.fields
+        capacity = fields["capacity"][row]
+        sums = self.sums
+        for name in ("cell_voltage", "current", "capacity", "capacity_remain", "soc", "soh"):
+            sums[name] += sign * fields[name][row]
+        sums["soc_weighted"] += sign * fields["soc"][row] * capacity
+        sums["soh_weighted"] += sign * fields["soh"][row] * capacity
+        sums["packs"] += sign
+
+    def update(self, bmsId, snapshot):
+        # Returns True when the pack changed the bank
+        row = bmsId - 1
+        if bmsId in self.present and self.fingerprints[row] == snapshot.fingerprint:
+            return False
+        if bmsId in self.present:
+            self.contribute(row, -1)
+        for name, values in self.fields.items():
+            values[row] = getattr(snapshot, name)
+        base = row * self.slots
+        count = len(snapshot.cells)
+        for idx in range(self.slots):
+            self.cells[base + idx] = snapshot.cells[idx] if idx < count else nan
+        self.alarms[row] = (snapshot.warning_hex, snapshot.protection_hex, snapshot.error_hex)
+        self.fingerprints[row] = snapshot.fingerprint
+        self.present.add(bmsId)
+        self.contribute(row, 1)
+        self.changed()
+        return True
+
+    def remove(self, bmsId):
+        row = bmsId - 1
+        if bmsId not in self.present:
+            return False
+        self.contribute(row, -1)
+        for values in self.fields.values():
+            values[row] = nan
+        base = row * self.slots
+        for idx in range(self.slots):
+            self.cells[base + idx] = nan
+        self.alarms[row] = (0, 0, 0)
+        self.fingerprints[row] = None
+        self.present.discard(bmsId)
+        self.changed()
+        return True
+
+    def changed(self):
+        self.dirty = True
+        self.generation += 1
+        self.updates += 1
+        if self.updates >= self.RESUM_AFTER:
+            self.updates = 0
+            self.sums = dict.fromkeys(self.SUMS, 0.0)
+            for bmsId in self.present:
+                self.contribute(bmsId - 1, 1)
+
+    def pack_cells(self, bmsId, count):
+        base = (bmsId - 1) * self.slots
+        return self.cells[base:base + count]
+
+    def aggregate(self):
+        # Packs are in parallel: voltage is the mean, current / capacity are summed,
+        # SoC and SoH are weighted by pack capacity, cycles and temperatures take the max
+        if not self.dirty:
+            return self.result
+        sums = self.sums
+        if sums["capacity"] > 0:
+            soc = sums["soc_weighted"] / sums["capacity"]
+            soh = sums["soh_weighted"] / sums["capacity"]
+        else:
+            soc = sums["soc"] / sums["packs"]
+            soh = sums["soh"] / sums["packs"]
+        result = {
+            "voltage" : sums["cell_voltage"] / sums["packs"],
+            "current" : sums["current"],
+            "capacity" : sums["capacity"],
+            "capacity_remain" : sums["capacity_remain"],
+            "soc" : soc,
+            "soh" : soh,
+        }
+        if np is not None:
+            result.update(self.extremes_numpy())
+        else:
+            result.update(self.extremes_array())
+        result["cell_spread"] = result["cell_max"] - result["cell_min"]
+
+        warning = protection = error = 0
+        for bmsId in self.present:
+            packWarning, packProtection, packError = self.alarms[bmsId - 1]
+            warning |= packWarning
+            protection |= packProtection
+            error |= packError
+        result["alarms"] = (warning, protection, error)
+
+        self.result = result
+        self.dirty = False
+        return result
+
+    def extremes_numpy(self):
+        fields = self.fields_np
+        return {
+            "cycles" : int(np.nanmax(fields["cycles"])),
+            "temp1" : float(np.nanmax(fields["temp1"])),
+            "temp2" : float(np.nanmax(fields["temp2"])),
+            "temp_mos" : float(np.nanmax(fields["temp_mos"])),
+            "cell_min" : float(np.nanmin(self.cells_np)),
+            "cell_max" : float(np.nanmax(self.cells_np)),
+        }
+
+    def extremes_array(self):
+        fields = self.fields
+        rows = [bmsId - 1 for bmsId in self.present]
+        cells = [volt for volt in self.cells if not isnan(volt)]
+        return {
+            "cycles" : int(max(fields["cycles"][row] for row in rows)),
+            "temp1" : max(fields["temp1"][row] for row in rows),
+            "temp2" : max(fields["temp2"][row] for row in rows),
+            "temp_mos" : max(fields["temp_mos"][row] for row in rows),
+            "cell_min" : min(cells),
+            "cell_max" : max(cells),
+        }
+
+
+class MonotonicQueue:
+    # Sample sequence numbers whose values are decreasing (max) or increasing
+    # (min), oldest first, held in a preallocated ring. The front is the max /
+    # min of the window. Amortised O(1) per sample and no allocation.
+
+    __slots__ = ("seqs", "size", "head", "tail", "is_max")
+
+    def __init__(self, size, is_max):
+        self.seqs = array("q", [0]) * size
+        self.size = size
+        self.head = 0
+        self.tail = 0
+        self.is_max = is_max
+
+    def push(self, seq, value, values, capacity):
+        seqs = self.seqs
+        size = self.size
+        while self.tail > self.head:
+            back = values[seqs[(self.tail - 1) % size] % capacity]
+            if (back <= value) if self.is_max else (back >= value):
+                self.tail -= 1
+            else:
+                break
+        seqs[self.tail % size] = seq
+        self.tail += 1
+
+    def expire(self, first_seq):
+        while self.head < self.tail and self.seqs[self.head % self.size] < first_seq:
+            self.head += 1
+
+    def front(self):
+        if self.head == self.tail:
+            return None
+        return self.seqs[self.head % self.size]
+
+
+class HistoryRing:
+    # Fixed-memory history of one pack: a timestamp ring shared by one value
+    # ring per metric. Appending overwrites the oldest sample in place.
+    # Running aggregates are kept while appending: a prefix-sum ring gives the
+    # mean of any window from two lookups, and monotonic queues keep min / max
+    # for the configured windows. Other windows fall back to a scan.
+
+    def __init__(self, metrics, capacity, windows):
+        self.metrics = tuple(metrics)
+        self.index = {name : idx for idx, name in enumerate(self.metrics)}
+        self.capacity = capacity
+        self.windows = tuple(windows)
+        self.count = 0
+        self.times = array("d", [0.0]) * capacity
+        self.values = [array("d", [nan]) * capacity for name in self.metrics]
+        # prefix[seq % (capacity + 1)] = sum of every value up to and including seq
+        self.prefix = [array("d", [0.0]) * (capacity + 1) for name in self.metrics]
+        self.totals = array("d", [0.0]) * len(self.metrics)
+        # One slot more than the ring, a queue can briefly hold the new sample next to a full window
+        self.queues = [
+            [(MonotonicQueue(capacity + 1, False), MonotonicQueue(capacity + 1, True)) for window in self.windows]
+            for name in self.metrics
+        ]
+        self.window_first = array("q", [0]) * len(self.windows)
+
+    def append(self, timestamp, values):
+        seq = self.count
+        slot = seq % self.capacity
+        self.times[slot] = timestamp
+        self.count = seq + 1
+        # Every window's queues drop what fell out of that window (or out of the ring)
+        # before the new value overwrites the oldest slot
+        oldest = max(0, seq + 1 - self.capacity)
+        for windowIdx, window in enumerate(self.windows):
+            self.window_first[windowIdx] = max(oldest, self.first_seq_after(timestamp - window))
+        for idx in range(len(self.metrics)):
+            value = values[idx]
+            ring = self.values[idx]
+            queues = self.queues[idx]
+            for windowIdx in range(len(queues)):
+                minimum, maximum = queues[windowIdx]
+                minimum.expire(self.window_first[windowIdx])
+                maximum.expire(self.window_first[windowIdx])
+            ring[slot] = value
+            self.totals[idx] += value
+            self.prefix[idx][seq % (self.capacity + 1)] = self.totals[idx]
+            for minimum, maximum in queues:
+                minimum.push(seq, value, ring, self.capacity)
+                maximum.push(seq, value, ring, self.capacity)
+
+    def first_seq_after(self, start_time):
+        # Oldest stored sample at or after start_time, binary search over the ring
+        low = max(0, self.count - self.capacity)
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[middle % self.capacity] < start_time:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def window(self, metric, seconds, now=None):
+        if self.count == 0:
+            return None
+        if now is None:
+            now = monotonic()
+        idx = self.index[metric]
+        ring = self.values[idx]
+        first = self.first_seq_after(now - seconds)
+        last = self.count - 1
+        if first > last:
+            return None
+        prefix = self.prefix[idx]
+        total = prefix[last % (self.capacity + 1)]
+        if first > 0:
+            total -= prefix[(first - 1) % (self.capacity + 1)]
+        samples = last - first + 1
+
+        if seconds in self.windows:
+            minimum, maximum = self.queues[idx][self.windows.index(seconds)]
+            minimum.expire(first)
+            maximum.expire(first)
+            low = ring[minimum.front() % self.capacity]
+            high = ring[maximum.front() % self.capacity]
+        else:
+            span = [ring[seq % self.capacity] for seq in range(first, last + 1)]
+            low = min(span)
+            high = max(span)
+
+        return {
+            "min" : low,
+            "max" : high,
+            "mean" : total / samples,
+            "last" : ring[last % self.capacity],
+            "samples" : samples,
+            "age" : now - self.times[last % self.capacity],
+        }
+
+
+class BankHistory:
+    # Per pack history rings, created on the first sample of a pack
+
+    PACK_METRICS = ("voltage", "current", "soc", "temp1", "temp2", "temp_mos")
+
+    def __init__(self, horizon, interval, windows):
+        self.capacity = max(1, ceil(horizon / interval))
+        self.windows = tuple(window for window in windows if window <= horizon)
+        self.packs = {}
+        self.sample = {}
+
+    def record(self, bmsId, snapshot):
+        ring = self.packs.get(bmsId)
+        if ring is None:
+            metrics = self.PACK_METRICS + tuple(f"cell{cellId}" for cellId in range(1, len(snapshot.cells) + 1))
+            ring = HistoryRing(metrics, self.capacity, self.windows)
+            self.packs[bmsId] = ring
+            self.sample[bmsId] = array("d", [0.0]) * len(metrics)
+        sample = self.sample[bmsId]
+        idx = 0
+        for name in self.PACK_METRICS:
+            sample[idx] = getattr(snapshot, name)
+            idx += 1
+        cells = snapshot.cells
+        for cellIdx in range(min(len(sample) - idx, len(cells))):
+            sample[idx + cellIdx] = cells[cellIdx]
+        ring.append(snapshot.timestamp, sample)
+
+    def query(self, bmsId, metric, seconds, now=None):
+        if bmsId not in self.packs:
+            return None
+        return self.packs[bmsId].window(metric, seconds, now)
+
+
+class CellHealth:
+    # Streaming per-cell analytics over every CELL / FAST frame, state in
+    # preallocated arrays (row = BMS ID - 1, one slot per cell), O(1) per cell:
+    #  - EWMA mean and variance of the cell voltage
+    #  - offset: EWMA of the cell voltage minus its pack mean, drift: offset now
+    #    minus the offset once the EWMA had settled
+    #  - resistance: EWMA of dV / dI of the cell across current steps of at least
+    #    min_step amps between two frames less than max_gap seconds apart
+    #  - outlier: how many pack standard deviations the cell's offset (or its
+    #    resistance, once every cell has one) is away from the other cells
+
+    MIN_SPREAD = 0.001  # Floor of the pack standard deviation in outlier scores (1 mV)
+    MIN_RESISTANCE_SPREAD = 0.0001
+
+    def __init__(self, alpha=0.05, min_step=5.0, max_gap=10.0, packs=BANK_PACKS, slots=CELL_SLOTS):
+        self.alpha = alpha
+        self.settle = ceil(1 / alpha)  # Samples before the drift baseline is taken
+        self.min_step = min_step
+        self.max_gap = max_gap
+        self.slots = slots
+        size = packs * slots
+        self.samples = array("q", [0]) * size
+        self.mean = array("d", [0.0]) * size
+        self.variance = array("d", [0.0]) * size
+        self.offset = array("d", [0.0]) * size
+        self.baseline = array("d", [nan]) * size
+        self.resistance = array("d", [nan]) * size
+        self.resistance_samples = array("q", [0]) * size
+        self.outlier = array("d", [0.0]) * size
+        self.last_voltage = array("d", [nan]) * size
+        self.last_current = array("d", [nan]) * packs
+        self.last_time = array("d", [0.0]) * packs
+        self.cell_count = array("q", [0]) * packs
+
+    def update(self, bmsId, snapshot):
+        row = bmsId - 1
+        cells = snapshot.cells
+        count = min(len(cells), self.slots)
+        if count == 0:
+            return
+        base = row * self.slots
+        alpha = self.alpha
+        packMean = snapshot.cell_voltage / len(cells)
+        current = snapshot.current
+        lastCurrent = self.last_current[row]
+        step = current - lastCurrent
+        resistanceStep = (
+            not isnan(lastCurrent) and abs(step) >= self.min_step
+            and snapshot.timestamp - self.last_time[row] <= self.max_gap
+        )
+        self.cell_count[row] = count
+
+        for idx in range(base, base + count):
+            volt = cells[idx - base]
+            offset = volt - packMean
+            samples = self.samples[idx]
+            if samples == 0:
+                self.mean[idx] = volt
+                self.variance[idx] = 0.0
+                self.offset[idx] = offset
+            else:
+                delta = volt - self.mean[idx]
+                self.mean[idx] += alpha * delta
+                self.variance[idx] = (1 - alpha) * (self.variance[idx] + alpha * delta * delta)
+                self.offset[idx] += alpha * (offset - self.offset[idx])
+            samples += 1
+            self.samples[idx] = samples
+            if samples == self.settle:
+                self.baseline[idx] = self.offset[idx]
+            if resistanceStep:
+                resistance = (volt - self.last_voltage[idx]) / step
+                if self.resistance_samples[idx] == 0:
+                    self.resistance[idx] = resistance
+                else:
+                    self.resistance[idx] += alpha * (resistance - self.resistance[idx])
+                self.resistance_samples[idx] += 1
+            self.last_voltage[idx] = volt
+        self.last_current[row] = current
+        self.last_time[row] = snapshot.timestamp
+        self.score(base, count)
+
+    def score(self, base, count):
+        # Two passes over the pack's cells: mean / deviation of offsets and resistances, then the z scores
+        offsetSum = offsetSquares = resistanceSum = resistanceSquares = 0.0
+        resistanceCells = 0
+        for idx in range(base, base + count):
+            offset = self.offset[idx]
+            offsetSum += offset
+            offsetSquares += offset * offset
+            if self.resistance_samples[idx]:
+                resistance = self.resistance[idx]
+                resistanceSum += resistance
+                resistanceSquares += resistance * resistance
+                resistanceCells += 1
+        offsetMean = offsetSum / count
+        offsetSpread = max(self.MIN_SPREAD, max(0.0, offsetSquares / count - offsetMean * offsetMean) ** 0.5)
+        useResistance = resistanceCells == count and count > 1
+        if useResistance:
+            resistanceMean = resistanceSum / count
+            resistanceSpread = max(
+                self.MIN_RESISTANCE_SPREAD, max(0.0, resistanceSquares / count - resistanceMean * resistanceMean) ** 0.5
+            )
+        for idx in range(base, base + count):
+            score = abs(self.offset[idx] - offsetMean) / offsetSpread
+            if useResistance:
+                score = max(score, abs(self.resistance[idx] - resistanceMean) / resistanceSpread)
+            self.outlier[idx] = score
+
+    def pack(self, bmsId):
+        # Current scores of one pack as a list of dicts, one per cell, None before its first frame
+        row = bmsId - 1
+        count = self.cell_count[row]
+        if count == 0:
+            return None
+        base = row * self.slots
+        cells = []
+        for idx in range(base, base + count):
+            baseline = self.baseline[idx]
+            resistance = self.resistance[idx]
+            cells.append({
+                "mean" : self.mean[idx],
+                "std" : self.variance[idx] ** 0.5,
+                "offset" : self.offset[idx],
+                "drift" : None if isnan(baseline) else self.offset[idx] - baseline,
+                "resistance" : None if isnan(resistance) else resistance,
+                "resistance_samples" : self.resistance_samples[idx],
+                "outlier" : self.outlier[idx],
+                "samples" : self.samples[idx],
+            })
+        return cells
+
+
+# Diff status records: (field, deadband). A change smaller than the deadband is not logged,
+# None logs any change. Cell voltages use STATUS_CELL_DEADBAND.
+STATUS_BANK_FIELDS = (
+    ("voltage", 0.02), ("current", 0.5), ("soc", 1), ("capacity_remain", 1),
+    ("temp_max", 1), ("temp_min", 1), ("cell_min_voltage", 0.005), ("cell_max_voltage", 0.005),
+    ("balacing_text", None),
+)
+STATUS_PACK_FIELDS = (
+    ("voltage", 0.02), ("current", 0.5), ("soc", 1), ("temp1", 1), ("temp2", 1), ("temp_mos", 1),
+    ("status_hex", None), ("heater_status", None), ("balancing_code", None),
+)
+STATUS_CELL_DEADBAND = 0.005
+
+
+class StatusDiff:
+    # Compact status records for the log: the values last logged are kept, a
+    # record only carries what moved past its deadband since then. A full
+    # snapshot is due periodically, on the first record and whenever an alarm
+    # mask of the bank or of a pack changes.
+
+    def __init__(self, snapshot_interval):
+        self.snapshot_interval = snapshot_interval
+        self.bank = {}
+        self.packs = {}
+        self.alarms = None
+        self.snapshot_time = None
+
+    @staticmethod
+    def moved(old, new, deadband):
+        if old is None or new is None:
+            return old is not new
+        if deadband is None:
+            return old != new
+        return abs(new - old) >= deadband
+
+    def alarm_state(self, battery, battery_stats):
+        packs = tuple(
+            (bmsId, snapshot.warning_hex, snapshot.protection_hex, snapshot.error_hex)
+            for bmsId, snapshot in battery_stats.items() if snapshot is not False
+        )
+        return (battery.alarm_warning, battery.alarm_protection, battery.alarm_error, packs)
+
+    def record(self, battery, battery_stats, now):
+        # The next record as a dict, None when nothing moved
+        alarms = self.alarm_state(battery, battery_stats)
+        if (
+            self.snapshot_time is None or alarms != self.alarms
+            or now - self.snapshot_time >= self.snapshot_interval
+        ):
+            self.alarms = alarms
+            self.snapshot_time = now
+            return self.snapshot(battery, battery_stats)
+
+        record = {}
+        bank = {}
+        for name, deadband in STATUS_BANK_FIELDS:
+            value = getattr(battery, name, None)
+            if self.moved(self.bank.get(name), value, deadband):
+                bank[name] = self.bank[name] = value
+        if bank:
+            record["bank"] = bank
+        packs = {}
+        for bmsId, snapshot in battery_stats.items():
+            if snapshot is False:
+                continue
+            last = self.packs.setdefault(bmsId, {})
+            pack = {}
+            for name, deadband in STATUS_PACK_FIELDS:
+                value = getattr(snapshot, name)
+                if self.moved(last.get(name), value, deadband):
+                    pack[name] = last[name] = value
+            lastCells = last.setdefault("cells", [])
+            cells = {}
+            for idx, cellVolt in enumerate(snapshot.cells):
+                if idx >= len(lastCells):
+                    lastCells.append(None)
+                if self.moved(lastCells[idx], cellVolt, STATUS_CELL_DEADBAND):
+                    cells[idx + 1] = lastCells[idx] = cellVolt
+            if cells:
+                pack["cells"] = cells
+            if bmsId in battery.stale_packs and not last.get("stale"):
+                pack["stale"] = last["stale"] = True
+            elif bmsId not in battery.stale_packs and last.get("stale"):
+                pack["stale"] = last["stale"] = False
+            if pack:
+                packs[bmsId] = pack
+        if packs:
+            record["packs"] = packs
+        return record or None
+
+    def snapshot(self, battery, battery_stats):
+        self.bank = {name : getattr(battery, name, None) for name, deadband in STATUS_BANK_FIELDS}
+        self.packs = {}
+        packs = {}
+        for bmsId, snapshot in battery_stats.items():
+            if snapshot is False:
+                continue
+            last = {name : getattr(snapshot, name) for name, deadband in STATUS_PACK_FIELDS}
+            last["cells"] = list(snapshot.cells)
+            last["stale"] = bmsId in battery.stale_packs
+            self.packs[bmsId] = last
+            pack = dict(last)
+            pack.update({
+                "serial" : snapshot.hw_serial,
+                "warning" : snapshot.warning_hex,
+                "protection" : snapshot.protection_hex,
+                "error" : snapshot.error_hex,
+            })
+            packs[bmsId] = pack
+        bank = dict(self.bank)
+        bank.update({
+            "warning" : alarm_text(battery.alarm_warning, WARNING_BITS, "Warning", "No Warnings"),
+            "protection" : alarm_text(battery.alarm_protection, PROTECTION_BITS, "Protection", "No Protection Events"),
+            "error" : alarm_text(battery.alarm_error, ERROR_BITS, "Error", "No Errors"),
+        })
+        return {"snapshot" : True, "bank" : bank, "packs" : packs}
+
+
+class WriteQueue:
+    # Pending register writes, drained by the poll loop between two packs.
+    # Keyed by (BMS ID, register): writing a register again before it went
+    # out only replaces its value (and keeps the more urgent priority), the
+    # callbacks of the replaced value are kept and get the result of the
+    # value that finally went out. The most urgent register goes out together
+    # with the pending registers around it on the same BMS as one
+    # multi-register write.
+    # Entry: [priority, sequence, value, attempts, [callback(bmsId, register, ok), ...]]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.heap = []
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, bmsId, register, values, priority=1, callback=None, attempts=0):
+        with self.lock:
+            for offset, value in enumerate(values):
+                key = (bmsId, register + offset)
+                entry = self.pending.get(key)
+                callbacks = [] if callback is None else [callback]
+                registerPriority = priority
+                if entry is not None:
+                    registerPriority = min(priority, entry[0])
+                    callbacks = entry[4] + callbacks
+                self.sequence += 1
+                self.pending[key] = [registerPriority, self.sequence, value & 0xFFFF, attempts, callbacks]
+                heappush(self.heap, (registerPriority, self.sequence, key))
+
+    def retry(self, bmsId, register, entry):
+        # A failed write goes back unless a newer value was queued meanwhile,
+        # its callbacks then wait for the newer value
+        with self.lock:
+            key = (bmsId, register)
+            if key in self.pending:
+                self.pending[key][4][:0] = entry[4]
+                return
+            self.sequence += 1
+            entry[1] = self.sequence
+            entry[3] += 1
+            self.pending[key] = entry
+            heappush(self.heap, (entry[0], self.sequence, key))
+
+    def take(self, max_registers=WRITE_BATCH_MAX, ready=None):
+        # (BMS ID, first register, entries) of the next write, removed from the queue, None when empty
+        # ready: optional ready(bmsId), writes to packs it rejects stay queued
+        with self.lock:
+            skipped = []
+            try:
+                while self.heap:
+                    item = heappop(self.heap)
+                    priority, sequence, key = item
+                    entry = self.pending.get(key)
+                    if entry is None or entry[1] != sequence:
+                        continue  # Coalesced or already written with a neighbour
+                    if ready is not None and not ready(key[0]):
+                        skipped.append(item)
+                        continue
+                    return self.take_batch(key, max_registers)
+                return None
+            finally:
+                for item in skipped:
+                    heappush(self.heap, item)
+
+    def take_batch(self, key, max_registers):
+        # Pops the run of queued neighbouring registers around key, caller holds the lock
+        bmsId, register = key
+        start = register
+        while (bmsId, start - 1) in self.pending and register - start + 1 < max_registers:
+            start -= 1
+        batch = []
+        while (bmsId, start + len(batch)) in self.pending and len(batch) < max_registers:
+            batch.append(self.pending.pop((bmsId, start + len(batch))))
+        return bmsId, start, batch
+
+
+PACK_HEALTHY = "healthy"
+PACK_SUSPECT = "suspect"
+PACK_QUARANTINED = "quarantined"
+
+
+class PackHealth:
+    # Circuit breaker for one BMS on the chain. A missed reply makes the pack
+    # suspect, enough misses in a row quarantine it. A quarantined pack is
+    # only re-probed after a backoff that doubles on every failed probe, so a
+    # dead BMS does not cost a read timeout on every poll cycle.
+
+    __slots__ = ("state", "failures", "backoff", "next_probe")
+
+    def __init__(self):
+        self.state = PACK_HEALTHY
+        self.failures = 0
+        self.backoff = 0
+        self.next_probe = 0
+
+    def should_poll(self, now):
+        return self.state != PACK_QUARANTINED or now >= self.next_probe
+
+    def record_success(self):
+        previous = self.state
+        self.state = PACK_HEALTHY
+        self.failures = 0
+        self.backoff = 0
+        return previous
+
+    def record_failure(self, now, quarantine_after, backoff_start, backoff_max):
+        previous = self.state
+        self.failures += 1
+        if self.state == PACK_QUARANTINED:
+            self.backoff = min(self.backoff * 2, backoff_max)
+        elif self.failures >= quarantine_after:
+            self.state = PACK_QUARANTINED
+            self.backoff = backoff_start
+        else:
+            self.state = PACK_SUSPECT
+        if self.state == PACK_QUARANTINED:
+            self.next_probe = now + self.backoff
+        return previous
+
+
+def decode_cell_frame(packet):
+    fields = CELL_FRAME.unpack_from(memoryview(packet), CELL_FRAME_OFFSET)
+    battery = PackSnapshot()
+    # Split like the frames: a FAST frame only replaces fields[:FAST_FRAME_FIELDS], so it
+    # hashes its own fields with the rest of the last CELL frame and matches when nothing changed
+    battery.slow_fingerprint = hash(fields[FAST_FRAME_FIELDS:])
+    battery.fingerprint = hash((battery.slow_fingerprint, fields[:FAST_FRAME_FIELDS]))
+    battery.voltage = fields[0] / 100
+    battery.current = fields[1] / 100
+    battery.temp1 = fields[18]
+    battery.capacity_remain = fields[19]
+    battery.max_battery_charge_current = fields[20]
+    battery.soh = fields[21]
+    battery.soc = fields[22]
+    battery.heater_status = "%02X" % fields[23]
+    battery.status_hex = "%02X" % fields[24]
+    battery.warning_hex = fields[25]
+    battery.protection_hex = fields[26]
+    battery.error_hex = fields[27]
+    battery.cycles = fields[28]
+    battery.capacity = fields[29] / 3600 / 1000
+    battery.temp2 = fields[30]
+    battery.temp_mos = fields[31]
+    battery.cell_count = fields[32]
+    battery.temp_max = max(battery.temp1, battery.temp2)
+    battery.temp_min = min(battery.temp1, battery.temp2)
+
+    cells = tuple(mv / 1000 for mv in fields[2:2 + min(battery.cell_count, CELL_SLOTS)])
+    battery.cells = cells
+    battery.cell_voltage = sum(cells)
+    battery.cell_max = max(cells)
+    battery.cell_min = min(cells)
+    return battery
+
+
+def decode_fast_frame(packet, previous):
+    # FAST reply only refreshes voltage, current and cells, the rest is carried over from the last CELL frame
+    fields = FAST_FRAME.unpack_from(memoryview(packet), CELL_FRAME_OFFSET)
+    battery = previous.copy()
+    battery.timestamp = monotonic()
+    battery.fingerprint = hash((previous.slow_fingerprint, fields))
+    battery.voltage = fields[0] / 100
+    battery.current = fields[1] / 100
+    cells = tuple(mv / 1000 for mv in fields[2:2 + min(battery.cell_count, CELL_SLOTS)])
+    battery.cells = cells
+    battery.cell_voltage = sum(cells)
+    battery.cell_max = max(cells)
+    battery.cell_min = min(cells)
+    return battery
+
+
+# CONFIG block (0x002D, 0x5B registers): (name, register offset in the block, scale, signed).
+# Cell voltages in mV, pack voltages in 10 mV, currents in A, temperatures in C.
+# Registers not listed here are kept undecoded in PackConfig.registers.
+# UNVERIFIED: these offsets are not taken from a documented register map or a captured
+# frame of a real BMS, the emulator fills its CONFIG block from this same table. CONFIG
+# is only read and decoded with config_balancer_thresholds on (off by default).
+CONFIG_FIELDS = (
+    ("cell_over_voltage_alarm", 0x00, 1000, False),
+    ("cell_over_voltage_protect", 0x01, 1000, False),
+    ("cell_over_voltage_release", 0x02, 1000, False),
+    ("cell_under_voltage_alarm", 0x03, 1000, False),
+    ("cell_under_voltage_protect", 0x04, 1000, False),
+    ("cell_under_voltage_release", 0x05, 1000, False),
+    ("pack_over_voltage_alarm", 0x06, 100, False),
+    ("pack_over_voltage_protect", 0x07, 100, False),
+    ("pack_over_voltage_release", 0x08, 100, False),
+    ("pack_under_voltage_alarm", 0x09, 100, False),
+    ("pack_under_voltage_protect", 0x0A, 100, False),
+    ("pack_under_voltage_release", 0x0B, 100, False),
+    ("charge_over_current_alarm", 0x0C, 1, False),
+    ("charge_over_current_protect", 0x0D, 1, False),
+    ("discharge_over_current_alarm", 0x0E, 1, False),
+    ("discharge_over_current_protect", 0x0F, 1, False),
+    ("charge_over_temp_alarm", 0x10, 1, True),
+    ("charge_over_temp_protect", 0x11, 1, True),
+    ("charge_under_temp_alarm", 0x12, 1, True),
+    ("charge_under_temp_protect", 0x13, 1, True),
+    ("discharge_over_temp_alarm", 0x14, 1, True),
+    ("discharge_over_temp_protect", 0x15, 1, True),
+    ("discharge_under_temp_alarm", 0x16, 1, True),
+    ("discharge_under_temp_protect", 0x17, 1, True),
+    ("mos_over_temp_alarm", 0x18, 1, True),
+    ("mos_over_temp_protect", 0x19, 1, True),
+    ("balancer_voltage", 0x1A, 1000, False),
+    ("balancer_delta", 0x1B, 1000, False),
+)
+CONFIG_FRAME = Struct(">%dH" % REGISTERS["CONFIG"][1])
+# Balancing thresholds unless config_balancer_thresholds uses a sane CONFIG read of the pack
+DEFAULT_BALANCER_VOLTAGE = 3.40
+DEFAULT_BALANCER_DELTA = 0.40
+
+
+class PackConfig:
+    # Decoded CONFIG block of one pack
+
+    __slots__ = tuple(name for name, offset, scale, signed in CONFIG_FIELDS) + ("registers", "raw", "valid", "timestamp")
+
+    def limits(self):
+        return {name : getattr(self, name) for name, offset, scale, signed in CONFIG_FIELDS}
+
+
+def decode_config_frame(packet):
+    registers = CONFIG_FRAME.unpack_from(memoryview(packet), FRAME_HEADER_LENGTH)
+    config = PackConfig()
+    for name, offset, scale, signed in CONFIG_FIELDS:
+        value = registers[offset]
+        if signed and value >= 0x8000:
+            value -= 0x10000
+        setattr(config, name, value / scale if scale != 1 else value)
+    config.registers = registers
+    config.raw = bytes(packet[FRAME_HEADER_LENGTH:FRAME_HEADER_LENGTH + CONFIG_FRAME.size])
+    config.timestamp = monotonic()
+    # An unset or garbled block must not drive balancing detection
+    config.valid = (
+        2.5 <= config.balancer_voltage <= 3.8
+        and 0 < config.balancer_delta < 1
+        and config.cell_under_voltage_protect < config.cell_over_voltage_protect
+    )
+    return config
+
+
+class PollScheduler:
+    # Multi-rate polling. Every register block has an interval in poll cycles
+    # and a priority (lower runs first). Blocks polled every cycle always run,
+    # slower blocks share a budget of reads per cycle so the bus load stays
+    # flat, and their first read is staggered by pack so packs do not all come
+    # due on the same cycle. A block deferred by the budget stays due.
+    # Without a fixed budget, it is the smallest one that keeps every block on
+    # its interval for the current number of packs.
+
+    def __init__(self, schedule, budget):
+        self.schedule = schedule
+        self.budget = budget
+        self.cycle = 0
+        self.next_due = {}
+
+    def plan(self, bmsIds):
+        plan = {bmsId : [] for bmsId in bmsIds}
+        due = []
+        for index, bmsId in enumerate(bmsIds):
+            for name, (interval, priority) in self.schedule.items():
+                if interval <= 1:
+                    plan[bmsId].append(name)
+                    continue
+                key = (bmsId, name)
+                if key not in self.next_due:
+                    self.next_due[key] = self.cycle + 1 + (index % interval)
+                if self.next_due[key] <= self.cycle:
+                    due.append((priority, self.next_due[key], bmsId, name))
+
+        budget = self.budget
+        if budget is None:
+            load = sum(len(bmsIds) / interval for interval, priority in self.schedule.values() if interval > 1)
+            budget = max(1, ceil(load))
+
+        due.sort()
+        for priority, due_cycle, bmsId, name in due[:budget]:
+            plan[bmsId].append(name)
+            self.next_due[(bmsId, name)] = self.cycle + self.schedule[name][0]
+        self.cycle += 1
+        return plan
+
+
+class EG4_LL_Serial:
+    # Persistent RS485 connection shared by every command EG4_LL sends.
+    # The port is opened once and kept open between polls, it is only closed
+    # and reopened after an I/O error on the port itself. A missing reply from a
+    # BMS is not an I/O error and does not cause a reopen.
+
+    def __init__(self, port, baud, timeout=0.1, reply_timeout=0.5):
+        self.port = port
+        self.baud = baud
+        self.timeout = timeout
+        self.reply_timeout = reply_timeout
+        self.ser = None
+        self.reopen_count = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.dropped_bytes = 0  # Bytes thrown away while resynchronising
+        self.last_partial = 0  # Bytes received by the last read that timed out
+        self.last_bad_crc = None  # Last complete candidate frame of the last read that failed its CRC
+
+    def is_open(self):
+        return self.ser is not None and self.ser.is_open
+
+    def open(self):
+        if self.is_open():
+            return True
+        try:
+            self.ser = serial.Serial(self.port, baudrate=self.baud, timeout=self.timeout)
+            return True
+        except (serial.SerialException, OSError) as e:
+            logger.error(f"Unable to open {self.port}: {e}")
+            self.ser = None
+            return False
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except (serial.SerialException, OSError):
+                pass
+        self.ser = None
+
+    def reopen(self):
+        self.close()
+        self.reopen_count += 1
+        logger.warning(f"Reopening {self.port} (reopen count: {self.reopen_count})")
+        return self.open()
+
+    def transact(self, command, data_length=None, reply_timeout=None):
+        # Returns the reply frame (including CRC), False on no reply. An I/O
+        # error reopens the port and retries the command once.
+        attempts = 0
+        while attempts < 2:
+            if not self.open():
+                return False
+            try:
+                self.ser.reset_input_buffer()
+                self.ser.write(command)
+                self.bytes_written += len(command)
+                return self.read_frame(command[0], command[1], data_length, reply_timeout)
+            except (serial.SerialException, OSError) as e:
+                logger.error(f"Serial I/O error on {self.port}: {e}")
+                if not self.reopen():
+                    return False
+            attempts += 1
+        return False
+
+    def read_frame(self, address, function, data_length=None, reply_timeout=None):
+        # Streaming Modbus RTU reader. Reads the header first, then exactly the
+        # number of bytes the header announces, so it returns as soon as the
+        # last CRC byte is on the wire instead of waiting out a timeout.
+        # Bytes that can not start a reply from this slave, and the first byte
+        # of a candidate frame whose CRC does not match, are dropped one at a
+        # time to resynchronise on the next candidate frame until the deadline.
+        # data_length overrides the byte count of the header, for replies too
+        # long for the single count byte to describe.
+        if reply_timeout is None:
+            reply_timeout = self.reply_timeout
+        deadline = monotonic() + reply_timeout
+        buffer = bytearray()
+        self.last_bad_crc = None
+        while True:
+            while len(buffer) >= 1 and buffer[0] != address:
+                del buffer[0]
+                self.dropped_bytes += 1
+            if len(buffer) >= 2 and buffer[1] not in (function, function | 0x80):
+                del buffer[0]
+                self.dropped_bytes += 1
+                continue
+
+            if len(buffer) >= 2 and buffer[1] & 0x80:
+                frame_length = FRAME_EXCEPTION_LENGTH
+            elif len(buffer) >= FRAME_HEADER_LENGTH and data_length is not None:
+                frame_length = FRAME_HEADER_LENGTH + data_length + FRAME_CRC_LENGTH
+            elif len(buffer) >= FRAME_HEADER_LENGTH:
+                frame_length = FRAME_HEADER_LENGTH + buffer[FRAME_HEADER_LENGTH - 1] + FRAME_CRC_LENGTH
+            else:
+                frame_length = FRAME_HEADER_LENGTH
+
+            if frame_length > FRAME_HEADER_LENGTH and len(buffer) >= frame_length:
+                frame = bytes(buffer[:frame_length])
+                if crc_valid(frame):
+                    return frame
+                self.last_bad_crc = frame
+                del buffer[0]
+                self.dropped_bytes += 1
+                continue
+
+            if monotonic() >= deadline:
+                self.last_partial = len(buffer)
+                return False
+            chunk = self.ser.read(frame_length - len(buffer))
+            self.bytes_read += len(chunk)
+            buffer += chunk
+
+
+# Bus multiplexer protocol (egll_mux.py), little endian. Request: command length,
+# expected data length (0 reads it from the reply header), reply timeout in seconds
+# (0 uses the daemon default), then the Modbus command. Reply: frame length (0 when
+# the BMS did not answer), bytes received before the timeout, then the frame. A reply
+# that failed its CRC is passed on as the frame, for the client to count.
+MUX_REQUEST = Struct("<BHf")
+MUX_REPLY = Struct("<HH")
+
+
+def recv_exact(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+
+class EG4_LL_MuxClient:
+    # Stands in for EG4_LL_Serial when another process owns the port: every
+    # command goes to the egll_mux.py daemon over its Unix socket. The daemon
+    # serialises requests from all of its clients and may answer reads from
+    # its short-lived reply cache.
+
+    def __init__(self, path, timeout=5.0):
+        self.port = path
+        self.timeout = timeout  # Covers the time queued behind other clients as well
+        self.sock = None
+        self.reopen_count = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.dropped_bytes = 0
+        self.last_partial = 0
+        self.last_bad_crc = None  # The daemon passes garbled replies on as the reply itself
+
+    def is_open(self):
+        return self.sock is not None
+
+    def open(self):
+        if self.is_open():
+            return True
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.port)
+            return True
+        except OSError as e:
+            logger.error(f"Unable to connect to bus multiplexer {self.port}: {e}")
+            self.close()
+            return False
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def reopen(self):
+        self.close()
+        self.reopen_count += 1
+        logger.warning(f"Reconnecting to {self.port} (reopen count: {self.reopen_count})")
+        return self.open()
+
+    def transact(self, command, data_length=None, reply_timeout=None):
+        # Same contract as EG4_LL_Serial.transact, a broken connection is retried once
+        attempts = 0
+        while attempts < 2:
+            if not self.open():
+                return False
+            try:
+                self.sock.sendall(MUX_REQUEST.pack(len(command), data_length or 0, reply_timeout or 0) + command)
+                self.bytes_written += len(command)
+                length, self.last_partial = MUX_REPLY.unpack(recv_exact(self.sock, MUX_REPLY.size))
+                if length == 0:
+                    return False
+                frame = recv_exact(self.sock, length)
+                self.bytes_read += length
+                return frame
+            except OSError as e:
+                logger.error(f"Bus multiplexer error on {self.port}: {e}")
+                if not self.reopen():
+                    return False
+            attempts += 1
+        return False
+
+
+# Outcomes counted per slave ID and command
+METRIC_REQUESTS = 0
+METRIC_OK = 1
+METRIC_TIMEOUT = 2
+METRIC_SHORT = 3
+METRIC_BAD_CRC = 4
+METRIC_EXCEPTION = 5
+METRIC_NAMES = ("requests", "ok", "timeouts", "short_frames", "bad_crc", "exceptions")
+METRIC_COMMANDS = ("HW", "CELL", "CONFIG", "FAST", "WIDE", "WRITE", "OTHER")
+LATENCY_BUCKETS_MS = (5, 10, 20, 50, 100, 200, 500, 1000)  # Upper bounds, the last bucket takes the rest
+PHASES = ("sweep", "io", "pace", "rollup", "status_logger")
+PHASE_SWEEP, PHASE_IO, PHASE_PACE, PHASE_ROLLUP, PHASE_STATUS_LOGGER = range(len(PHASES))
+
+
+class BusMetrics:
+    # Hot path counters for the bus. Everything lives in preallocated arrays
+    # indexed by slave ID and command, recording a sample is a few index
+    # operations with no allocation. Slave IDs outside 1 - 16 share row 0.
+
+    def __init__(self):
+        rows = (BANK_PACKS + 1) * len(METRIC_COMMANDS)
+        self.counts = array("q", [0]) * (rows * len(METRIC_NAMES))
+        self.latency = array("q", [0]) * (rows * (len(LATENCY_BUCKETS_MS) + 1))
+        self.latency_total = array("d", [0.0]) * rows
+        self.phase_total = array("d", [0.0]) * len(PHASES)
+        self.phase_count = array("q", [0]) * len(PHASES)
+        self.io_time = 0.0  # Running total of time spent in bus transactions
+        self.command_index = {}
+        self.started = monotonic()
+
+    def row(self, command):
+        if command[1] in WRITE_FUNCTIONS:
+            # Not cached, every write command carries its values
+            slave = command[0] if command[0] <= BANK_PACKS else 0
+            return slave * len(METRIC_COMMANDS) + METRIC_COMMANDS.index("WRITE")
+        index = self.command_index.get(command)
+        if index is None:
+            name = command_name(command)
+            if name not in METRIC_COMMANDS:
+                name = "OTHER"
+            slave = command[0] if command[0] <= BANK_PACKS else 0
+            index = slave * len(METRIC_COMMANDS) + METRIC_COMMANDS.index(name)
+            self.command_index[command] = index
+        return index
+
+    def record(self, command, outcome, seconds):
+        row = self.row(command)
+        base = row * len(METRIC_NAMES)
+        self.counts[base + METRIC_REQUESTS] += 1
+        self.counts[base + outcome] += 1
+        if outcome == METRIC_OK:
+            bucket = bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)
+            self.latency[row * (len(LATENCY_BUCKETS_MS) + 1) + bucket] += 1
+            self.latency_total[row] += seconds
+
+    def phase(self, index, seconds):
+        self.phase_total[index] += seconds
+        self.phase_count[index] += 1
+
+    def totals(self):
+        totals = [0] * len(METRIC_NAMES)
+        for idx, value in enumerate(self.counts):
+            totals[idx % len(METRIC_NAMES)] += value
+        return dict(zip(METRIC_NAMES, totals))
+
+    def snapshot(self):
+        # Plain dict of every non zero counter, built only when asked for
+        commands = {}
+        buckets = len(LATENCY_BUCKETS_MS) + 1
+        for row in range(len(self.latency_total)):
+            base = row * len(METRIC_NAMES)
+            if self.counts[base + METRIC_REQUESTS] == 0:
+                continue
+            slave, command = divmod(row, len(METRIC_COMMANDS))
+            entry = {name : self.counts[base + idx] for idx, name in enumerate(METRIC_NAMES)}
+            histogram = self.latency[row * buckets:(row + 1) * buckets]
+            entry["latency_ms"] = {
+                (f"<={bound}" if idx < len(LATENCY_BUCKETS_MS) else f">{LATENCY_BUCKETS_MS[-1]}") : histogram[idx]
+                for idx, bound in enumerate(LATENCY_BUCKETS_MS + (None,))
+            }
+            if entry["ok"]:
+                entry["latency_mean_ms"] = self.latency_total[row] / entry["ok"] * 1000
+            commands[f"{slave}/{METRIC_COMMANDS[command]}"] = entry
+        phases = {}
+        for idx, name in enumerate(PHASES):
+            if self.phase_count[idx]:
+                phases[name] = {
+                    "total_s" : self.phase_total[idx],
+                    "count" : self.phase_count[idx],
+                    "mean_ms" : self.phase_total[idx] / self.phase_count[idx] * 1000,
+                }
+        return {"uptime_s" : monotonic() - self.started, "commands" : commands, "phases" : phases}
+
+    def summary(self):
+        totals = self.totals()
+        line = (
+            f"Bus: {totals['requests']} requests, {totals['timeouts']} timeouts, {totals['short_frames']} short, "
+            f"{totals['bad_crc']} bad CRC, {totals['exceptions']} exceptions"
+        )
+        for idx, name in enumerate(PHASES):
+            if self.phase_count[idx]:
+                line += f" | {name} {self.phase_total[idx] / self.phase_count[idx] * 1000:.1f} ms"
+        return line
+
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+PACK_GAUGES = (
+    ("voltage", "Pack voltage in volts"),
+    ("current", "Pack current in amps, negative is discharge"),
+    ("soc", "State of charge in percent"),
+    ("soh", "State of health in percent"),
+    ("capacity", "Full capacity in amp hours"),
+    ("capacity_remain", "Remaining capacity in amp hours"),
+    ("max_battery_charge_current", "Maximum charge current in amps"),
+    ("temp1", "Temperature sensor 1 in celsius"),
+    ("temp2", "Temperature sensor 2 in celsius"),
+    ("temp_mos", "Mosfet temperature in celsius"),
+    ("cell_count", "Cells in the pack"),
+    ("cell_max", "Highest cell voltage in volts"),
+    ("cell_min", "Lowest cell voltage in volts"),
+    ("balancing_code", "Balancing state, 0 off, 1 balancing, 2 finished"),
+)
+BANK_GAUGES = (
+    ("voltage", "Bank voltage in volts"),
+    ("current", "Bank current in amps, negative is discharge"),
+    ("soc", "Bank state of charge in percent"),
+    ("capacity", "Bank capacity in amp hours"),
+    ("capacity_remain", "Bank remaining capacity in amp hours"),
+    ("cell_min_voltage", "Lowest cell voltage in the bank in volts"),
+    ("cell_max_voltage", "Highest cell voltage in the bank in volts"),
+    ("cell_voltage_spread", "Highest minus lowest cell voltage in the bank in volts"),
+)
+
+
+def metric_label(value):
+    return str(value).strip("\x00 ").replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics(battery, battery_stats):
+    # OpenMetrics text for the bank, every pack and the bus counters. Built once per
+    # sweep by the thread that finished it, scrapes only ever see the finished bytes.
+    lines = []
+    now = monotonic()
+    packs = [(bmsId, battery_stats[bmsId]) for bmsId in sorted(battery_stats) if battery_stats[bmsId] is not False]
+
+    for name, help in BANK_GAUGES:
+        value = getattr(battery, name, None)
+        if value is not None and not (isinstance(value, float) and isnan(value)):
+            lines.append(f"# TYPE eg4_ll_bank_{name} gauge")
+            lines.append(f"# HELP eg4_ll_bank_{name} {help}")
+            lines.append(f"eg4_ll_bank_{name} {value}")
+
+    lines.append("# TYPE eg4_ll_pack_hw info")
+    lines.append("# HELP eg4_ll_pack_hw Pack hardware identity")
+    for bmsId, snapshot in packs:
+        lines.append(
+            f'eg4_ll_pack_hw_info{{bms_id="{bmsId}",make="{metric_label(snapshot.hw_make)}",'
+            f'version="{metric_label(snapshot.hw_version)}",serial="{metric_label(snapshot.hw_serial)}"}} 1'
+        )
+    for name, help in PACK_GAUGES:
+        lines.append(f"# TYPE eg4_ll_pack_{name} gauge")
+        lines.append(f"# HELP eg4_ll_pack_{name} {help}")
+        for bmsId, snapshot in packs:
+            value = getattr(snapshot, name)
+            if value is not None:
+                lines.append(f'eg4_ll_pack_{name}{{bms_id="{bmsId}"}} {value}')
+    lines.append("# TYPE eg4_ll_pack_age_seconds gauge")
+    lines.append("# HELP eg4_ll_pack_age_seconds Seconds since the pack snapshot was read")
+    for bmsId, snapshot in packs:
+        lines.append(f'eg4_ll_pack_age_seconds{{bms_id="{bmsId}"}} {now - snapshot.timestamp:.3f}')
+    lines.append("# TYPE eg4_ll_pack_stale gauge")
+    lines.append("# HELP eg4_ll_pack_stale 1 while the pack is missing polls and its last snapshot is published")
+    for bmsId, snapshot in packs:
+        health = battery.get_pack_health(bmsId)
+        lines.append(f'eg4_ll_pack_stale{{bms_id="{bmsId}"}} {int(health is not None and health.state != PACK_HEALTHY)}')
+    lines.append("# TYPE eg4_ll_cell_voltage gauge")
+    lines.append("# HELP eg4_ll_cell_voltage Cell voltage in volts")
+    for bmsId, snapshot in packs:
+        for idx, cellVolt in enumerate(snapshot.cells or ()):
+            lines.append(f'eg4_ll_cell_voltage{{bms_id="{bmsId}",cell="{idx + 1}"}} {cellVolt}')
+
+    for register, bits in (("warning", WARNING_BITS), ("protection", PROTECTION_BITS), ("error", ERROR_BITS)):
+        lines.append(f"# TYPE eg4_ll_pack_{register} gauge")
+        lines.append(f"# HELP eg4_ll_pack_{register} 1 while the {register} bit is set")
+        for bmsId, snapshot in packs:
+            mask = getattr(snapshot, f"{register}_hex") or 0
+            for bit, (text, attribute) in bits.items():
+                lines.append(
+                    f'eg4_ll_pack_{register}{{bms_id="{bmsId}",bit="0x{bit:04X}",alarm="{text}"}} {int(bool(mask & bit))}'
+                )
+
+    health = [(bmsId, battery.get_cell_health(bmsId)) for bmsId, snapshot in packs]
+    health = [(bmsId, cells) for bmsId, cells in health if cells]
+    for name, help in (
+        ("offset", "EWMA of the cell voltage minus its pack mean in volts"),
+        ("resistance", "EWMA of dV / dI across current steps in ohms"),
+        ("outlier", "Pack standard deviations the cell is away from the other cells"),
+    ):
+        metric = f"eg4_ll_cell_{name}{'_ohms' if name == 'resistance' else ''}"
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"# HELP {metric} {help}")
+        for bmsId, cells in health:
+            for idx, cell in enumerate(cells):
+                if cell[name] is not None:
+                    lines.append(f'{metric}{{bms_id="{bmsId}",cell="{idx + 1}"}} {cell[name]}')
+
+    metrics = battery.metrics
+    commands = len(METRIC_COMMANDS)
+    buckets = len(LATENCY_BUCKETS_MS) + 1
+    rows = [row for row in range(len(metrics.latency_total)) if metrics.counts[row * len(METRIC_NAMES)]]
+    for idx, name in enumerate(METRIC_NAMES):
+        lines.append(f"# TYPE eg4_ll_bus_{name} counter")
+        lines.append(f"# HELP eg4_ll_bus_{name} Bus {name.replace('_', ' ')} per BMS ID and command")
+        for row in rows:
+            slave, command = divmod(row, commands)
+            lines.append(
+                f'eg4_ll_bus_{name}_total{{bms_id="{slave}",command="{METRIC_COMMANDS[command]}"}} '
+                f"{metrics.counts[row * len(METRIC_NAMES) + idx]}"
+            )
+    lines.append("# TYPE eg4_ll_bus_latency_seconds histogram")
+    lines.append("# HELP eg4_ll_bus_latency_seconds Request to complete reply time of good replies")
+    for row in rows:
+        slave, command = divmod(row, commands)
+        labels = f'bms_id="{slave}",command="{METRIC_COMMANDS[command]}"'
+        cumulative = 0
+        for bucket in range(buckets):
+            cumulative += metrics.latency[row * buckets + bucket]
+            bound = LATENCY_BUCKETS_MS[bucket] / 1000 if bucket < len(LATENCY_BUCKETS_MS) else "+Inf"
+            lines.append(f'eg4_ll_bus_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f"eg4_ll_bus_latency_seconds_count{{{labels}}} {cumulative}")
+        lines.append(f"eg4_ll_bus_latency_seconds_sum{{{labels}}} {metrics.latency_total[row]}")
+    lines.append("# TYPE eg4_ll_phase_seconds summary")
+    lines.append("# HELP eg4_ll_phase_seconds Time spent per poll phase")
+    for idx, name in enumerate(PHASES):
+        lines.append(f'eg4_ll_phase_seconds_count{{phase="{name}"}} {metrics.phase_count[idx]}')
+        lines.append(f'eg4_ll_phase_seconds_sum{{phase="{name}"}} {metrics.phase_total[idx]}')
+    for name in ("reopen_count", "bytes_written", "bytes_read", "dropped_bytes"):
+        lines.append(f"# TYPE eg4_ll_bus_{name} counter")
+        lines.append(f"eg4_ll_bus_{name}_total {getattr(battery.bus, name)}")
+    lines.append("# EOF\n")
+    return "\n".join(lines).encode()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # Never touches the driver, only sends the payload the last sweep published
+    timeout = 5
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        payload = self.server.payload
+        self.send_response(200)
+        self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsExporter:
+    # One HTTP thread serving the cached payload, scrapes are handled one at a time
+    # so a scrape storm queues on the socket instead of spawning threads
+
+    def __init__(self, address, port):
+        self.server = HTTPServer((address, port), MetricsHandler)
+        self.server.payload = b"# EOF\n"
+        self.thread = threading.Thread(target=self.server.serve_forever, name="EG4_LL exporter", daemon=True)
+        self.thread.start()
+
+    def publish(self, payload):
+        self.server.payload = payload
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+# Capture file: magic, then one record per request / reply pair:
+# monotonic timestamp, slave ID, request length, reply length, request bytes, reply bytes (empty = no reply)
+CAPTURE_MAGIC = b"EG4LLCP1"
+CAPTURE_RECORD = Struct("<dBHH")
+
+
+def command_name(command):
+    # Register block name of a read command, None if it is not one of ours
+    if command[1] != MODBUS_READ_HOLDING:
+        return None
+    start, count = unpack_from(">HH", command, 2)
+    for name, block in REGISTERS.items():
+        if block == (start, count):
+            return name
+    if (start, count) == register_span(WIDE_BLOCKS):
+        return "WIDE"
+    return None
+
+
+class FrameCapture:
+    # Appends every request / reply pair to a binary capture file through a
+    # buffered writer, flushed at most every flush_interval seconds
+
+    def __init__(self, path, flush_interval=5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "ab", buffering=1 << 16)
+        if new:
+            self.file.write(CAPTURE_MAGIC)
+        self.last_flush = monotonic()
+        self.records = 0
+
+    def write(self, timestamp, slave_id, request, reply):
+        self.file.write(CAPTURE_RECORD.pack(timestamp, slave_id, len(request), len(reply)))
+        self.file.write(request)
+        self.file.write(reply)
+        self.records += 1
+        if timestamp - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = timestamp
+
+    def close(self):
+        self.file.close()
+
+
+class FrameReplay:
+    # Memory-mapped reader for capture files, records are yielded as
+    # (timestamp, slave ID, request, reply) with memoryview slices into the map
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an EG4 LL capture file")
+
+    def __iter__(self):
+        view = memoryview(self.map)
+        offset = len(CAPTURE_MAGIC)
+        end = len(self.map)
+        try:
+            while offset + CAPTURE_RECORD.size <= end:
+                timestamp, slave_id, request_length, reply_length = CAPTURE_RECORD.unpack_from(view, offset)
+                offset += CAPTURE_RECORD.size
+                if offset + request_length + reply_length > end:
+                    break  # Truncated last record, the driver was stopped mid write
+                request = view[offset:offset + request_length]
+                offset += request_length
+                reply = view[offset:offset + reply_length]
+                offset += reply_length
+                yield timestamp, slave_id, request, reply
+        finally:
+            view.release()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class ReplayBus:
+    # Stands in for EG4_LL_Serial during a replay, transact returns the reply
+    # of the record being replayed
+
+    def __init__(self):
+        self.reply = False
+        self.reopen_count = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.dropped_bytes = 0
+        self.last_partial = 0
+        self.last_bad_crc = None
+
+    def is_open(self):
+        return True
+
+    def open(self):
+        return True
+
+    def close(self):
+        pass
+
+    def transact(self, command, data_length=None, reply_timeout=None):
+        return self.reply
+
+
 class EG4_LL(Battery):
-    def __init__(self, port, baud, address):
+    def __init__(self, port, baud, address, bus_index=0):
 
         super(EG4_LL, self).__init__(port, baud, address)
         self.cell_min_voltage = 0
@@ -55,76 +1770,134 @@ class EG4_LL(Battery):
         self.reset_soc = 0
         self.soc_to_set = None
         self.runtime = 1  # TROUBLESHOOTING for no reply errors
+        if self.mux_socket and bus_index == 0:
+            self.bus = EG4_LL_MuxClient(self.mux_socket)
+        else:
+            self.bus = EG4_LL_Serial(port, baud)
+        self.wide_read_rejected = set()
+        self.last_exception = None  # Exception code of the last reply, None when it was not an exception
+        self.pack_health = {}
+        self.stale_packs = {}
+        self.poller = None
+        self.poller_stop = threading.Event()
+        self.bank_front = {}
+        self.bank_time = monotonic()
+        schedule = self.POLL_SCHEDULE
+        if not self.config_balancer_thresholds:
+            # Nothing acts on the unverified CONFIG decode, do not spend bus time on it
+            schedule = {name : entry for name, entry in schedule.items() if name != "CONFIG"}
+        self.scheduler = PollScheduler(schedule, self.poll_budget)
+        self.alarm_warning = 0
+        self.alarm_protection = 0
+        self.alarm_error = 0
+        # Chains on extra_ports are polled by their own EG4_LL with its own poller thread,
+        # bus_index is their position in extra_ports (0 for this port)
+        self.bus_index = bus_index
+        self.chains = []
+        if bus_index == 0:
+            self.chains = [EG4_LL(chainPort, baud, address, bus) for bus, chainPort in enumerate(self.extra_ports, 1)]
+            for chain in self.chains:
+                # Fixed BMS ID's from an extra_ports mapping, otherwise the chain runs its own discovery
+                packIds = self.extra_ports.get(chain.port) if isinstance(self.extra_ports, dict) else None
+                chain.batteryPackId = list(packIds or [])
+        self.bank = BankArrays(BANK_PACKS * (1 + len(self.chains)))
+        self.balancing_cache = None
+        self.metrics = BusMetrics()
+        self.metrics_logged = monotonic()
+        self.capture = None
+        if self.capture_file:
+            self.capture = FrameCapture(self.capture_file if bus_index == 0 else f"{self.capture_file}.{bus_index}")
+        self.cell_health = None
+        if self.cell_health_alpha:
+            self.cell_health = CellHealth(self.cell_health_alpha, self.cell_health_current_step, self.cell_health_max_gap)
+        self.history = None
+        if self.history_horizon:
+            self.history = BankHistory(self.history_horizon, self.history_interval, self.history_windows)
+        self.cell_voltage_spread = 0
+        self.pack_config = {}
+        self.config_generation = 0  # Bumped whenever a pack's CONFIG changes, part of the balancing cache key
+        self.exporter = None
+        self.status_diff = None
+        self.writes = WriteQueue()
+        self.warm_packs = set()  # Packs loaded from the state file and not confirmed by the BMS yet
+        self.verify_pending = False
+        self.auto_discovery = False
+        self.state_saved = monotonic()
+        if bus_index:
+            self.exporter_port = None  # The first bus exports the merged bank
 
     # Modbus uses 7C call vs Lifepower 7E, as return values do not correlate to the Lifepower ones if 7E is used.
     # at least on my own BMS.
     statuslogger = False
+    status_format = "text"  # "text" logs the full status_logger dump, "diff" one JSON record of changed fields per sweep
+    status_snapshot_interval = 600  # Seconds between full JSON snapshots in "diff" mode, alarm changes log one at once
     debug = False  # Set to true for wordy debugging in logs
     debug_hex = False
     debug_config_hex = False
     debug_config = False
+    # Read CONFIG of every pack and detect balancing from its decoded balancer thresholds.
+    # CONFIG_FIELDS is not checked against a real BMS yet, off skips the CONFIG reads and
+    # keeps the 3.40 V / 0.40 V defaults
+    config_balancer_thresholds = False
     batteryPackId = [ 16, 1 ]
     battery_stats = {}
+    wide_read = False  # Read HW and CELL with one request per pack, falls back per pack if the BMS rejects it
+    discovery_timeout = 0.2  # Reply timeout in seconds while probing for packs
+    discovery_attempts = 2
+    quarantine_after = 3  # Missed replies in a row before a pack is quarantined
+    quarantine_backoff = 5  # Seconds before the first re-probe of a quarantined pack, doubles up to the max
+    quarantine_backoff_max = 300
+    threaded = False  # Poll the chain from a background thread, refresh_data only rolls up the latest sweep
+    # Further RS485 adapters, each with its own chain and master 16, e.g. ("/dev/ttyUSB1", "/dev/ttyUSB2").
+    # Their BMS ID's are discovered per chain, a mapping fixes them per port instead, e.g.
+    # {"/dev/ttyUSB1" : [16, 1, 2], "/dev/ttyUSB2" : []} (an empty list discovers that chain).
+    # Every bus gets its own poller thread and the packs merge into one bank as bus * 16 + BMS ID
+    # (bus 0 is this port), so a cycle takes as long as the slowest bus. Forces threaded polling.
+    extra_ports = ()
+    mux_socket = None  # Unix socket of an egll_mux.py daemon owning the port, None opens the port directly
+    poller_interval = 1.0  # Minimum seconds between the start of two sweeps in threaded mode
+    bank_stale_after = 10  # Seconds without a complete sweep before refresh_data reports a failure
+    # Register block: (interval in poll cycles, priority). Cell voltages and current every cycle,
+    # temperatures, SoC and alarms (full CELL block) every few cycles, identity and config every few minutes
+    POLL_SCHEDULE = {
+        "FAST" : (1, 0),
+        "CELL" : (5, 1),
+        "HW" : (300, 2),
+        "CONFIG" : (300, 3),
+    }
+    capture_file = None  # Path of a binary capture of every request / reply, None disables capturing
+    metrics_log_interval = 0  # Seconds between bus metrics summary log lines, 0 disables them
+    exporter_port = None  # TCP port of the OpenMetrics endpoint (e.g. 9480), None disables it
+    exporter_address = "127.0.0.1"  # Interface the OpenMetrics endpoint listens on
+    writes_enabled = False  # Allow register writes through queue_write, off leaves the BMS read only
+    write_slot_min = 0.1  # Seconds of the bus gap between packs a write and its read back need to be started
+    write_attempts = 3  # Tries per register before a write is reported as failed
+    cell_health_alpha = 0.05  # EWMA weight of the streaming cell analytics, 0 disables them
+    cell_health_current_step = 5.0  # Amps the pack current has to step between two frames for a resistance sample
+    cell_health_max_gap = 10.0  # Seconds two frames may be apart for a resistance sample
+    history_horizon = 0  # Seconds of per-pack / per-cell history kept in memory, 0 disables it (600 costs ~10 MB for 16 packs)
+    history_interval = 1.0  # Expected seconds between two samples of a pack, sizes the history rings
+    history_windows = (60, 300)  # Windows in seconds with O(1) min / max queries
+    poll_budget = None  # Slower register blocks read per poll cycle across the whole chain, None sizes it to the chain
+    # Chain found by the last full scan, verified in one pass on the next start
+    topology_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eg4_ll_topology.json")
+    # Last HW identity and CELL stats of every pack. On start the driver publishes them (marked stale)
+    # after a single CELL read of the master, the first poll sweep verifies and refreshes every pack.
+    # None disables warm starts.
+    state_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eg4_ll_state.json")
+    state_save_interval = 300  # Seconds between two writes of the state file
 
     #balancing = 0
     BATTERYTYPE = "EG4 LL"
     balacing_text = "UNKNOWN"
-    LENGTH_CHECK = 0
-    LENGTH_CHECK
+    LENGTH_CHECK = 2  # CRC16 trails every reply
     LENGTH_POS = 2  # offset starting from 0
     LENGTH_FIXED = -1
 
-    commands = {
-      16 : {
-        "HW" : b"\x10\x03\x00\x69\x00\x17\xD6\x99",
-        "CELL" : b"\x10\x03\x00\x00\x00\x27\x06\x91"},
-      1 : {
-        "HW" : b"\x01\x03\x00\x69\x00\x17\xD5\xD8",
-        "CELL" : b"\x01\x03\x00\x00\x00\x27\x05\xD0",
-        "CONFIG" : b"\x01\x03\x00\x2D\x00\x5B\x94\x38"},
-      2: {
-        "HW" : b"\x02\x03\x00\x69\x00\x17\xD5\xEB",
-        "CELL" : b"\x02\x03\x00\x00\x00\x27\x05\xE3"},
-      3: {
-        "HW" : b"\x03\x03\x00\x69\x00\x17\xD4\x3A",
-        "CELL" : b"\x03\x03\x00\x00\x00\x27\x04\x32"},
-      4: {
-        "HW" : b"\x04\x03\x00\x69\x00\x17\xD5\x8D",
-        "CELL" : b"\x04\x03\x00\x00\x00\x27\x05\x85"},
-      5: {
-        "HW" : b"\x05\x03\x00\x69\x00\x17\xD4\x5C",
-        "CELL" : b"\x05\x03\x00\x00\x00\x27\x04\x54"},
-      6: {
-        "HW" : b"\x06\x03\x00\x69\x00\x17\xD4\x6F",
-        "CELL" : b"\x06\x03\x00\x00\x00\x27\x04\x67"},
-      7: {
-        "HW" : b"\x07\x03\x00\x69\x00\x17\xD5\xBE",
-        "CELL" : b"\x07\x03\x00\x00\x00\x27\x05\xB6"},
-      8: {
-        "HW" : b"\x08\x03\x00\x69\x00\x17\xD5\x41",
-        "CELL" : b"\x08\x03\x00\x00\x00\x27\x05\x49"},
-      9: {
-        "HW" : b"\x09\x03\x00\x69\x00\x17\xD4\x90",
-        "CELL" : b"\x09\x03\x00\x00\x00\x27\x04\x98"},
-      10: {
-        "HW" : b"\x0A\x03\x00\x69\x00\x17\xD4\xA3",
-        "CELL" : b"\x0A\x03\x00\x00\x00\x27\x04\xAB"},
-      11: {
-        "HW" : b"\x0B\x03\x00\x69\x00\x17\xD5\x72",
-        "CELL" : b"\x0B\x03\x00\x00\x00\x27\x05\x7A"},
-      12: {
-        "HW" : b"\x0C\x03\x00\x69\x00\x17\xD4\xC5",
-        "CELL" : b"\x0C\x03\x00\x00\x00\x27\x04\xCD"},
-      13: {
-        "HW" : b"\x0D\x03\x00\x69\x00\x17\xD5\x14",
-        "CELL" : b"\x0D\x03\x00\x00\x00\x27\x05\x1c"},
-      14: {
-        "HW" : b"\x0E\x03\x00\x69\x00\x17\xD5\x27",
-        "CELL" : b"\x0E\x03\x00\x00\x00\x27\x05\x2F"},
-      15: {
-        "HW" : b"\x0F\x03\x00\x69\x00\x17\xD4\xF6",
-        "CELL" : b"\x0F\x03\x00\x00\x00\x27\x04\xFE"}
-    }
+    REGISTERS = REGISTERS
+
+    # Read commands for every DIP switch ID on the chain, 16 is the master and 1 - 15 the slaves
+    commands = build_commands(range(1, 17))
 
     def unique_identifier(self):
         return "4S12400190500001"
@@ -135,18 +1908,24 @@ class EG4_LL(Battery):
         # Return True if success, False for failure
         try:
             self.battery_stats = {}
+            if not self.bus.open():
+                return False
+            if self.warm_start():
+                self.connect_chains()
+                return True
             BMS_list = self.discovery_pack()
             if len(BMS_list) > 0:
                 if 16 in BMS_list:
-                    self.battery_stats[16] = self.read_cell_details(16)
+                    if 16 not in self.battery_stats:
+                        self.battery_stats[16] = self.read_cell_details(16)
                     if self.battery_stats[16] is not False:
                         reply = self.rollupBatteryBank(self.battery_stats)
                         if reply != "Failed":
+                            self.connect_chains()
                             return True
-                        else:
-                            return False
-                    else:
-                        return False
+            # Release the port so the next driver probed on it can open it
+            self.bus.close()
+            return False
         except Exception:
             (
                 exception_type,
@@ -158,6 +1937,8 @@ class EG4_LL(Battery):
             logger.error(
                 f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}"
             )
+            self.bus.close()
+            return False
 
     def get_settings(self):
         # After successful  connection get_settings will be call to set up the battery.
@@ -165,69 +1946,239 @@ class EG4_LL(Battery):
         id = 1
         battery_stats = {}
         for id in self.batteryPackId:
-            hw_reply = self.read_hw_details(id)
-            cell_reply = self.read_cell_details(id)
-            if hw_reply is not False and cell_reply is not False:
-                self.battery_stats[id] = { **cell_reply, **hw_reply }
+            if id in self.battery_stats and self.battery_stats[id] is not False:
+                if self.battery_stats[id].hw_serial is not None:
+                    continue  # Already read in full by discovery_pack
+            reply = self.read_pack_details(id)
+            if reply is not False:
+                self.battery_stats[id] = reply
             id+=1
 
-        result = self.rollupBatteryBank(self.battery_stats)
-        if (self.statuslogger is True) or (result == "Failed"):
-            self.status_logger(self.battery_stats)
+        # Thresholds for balancing detection, later refreshed on the slow CONFIG schedule.
+        # After a warm start the verifying sweep reads them instead.
+        for id in self.batteryPackId:
+            if self.verify_pending or not self.config_balancer_thresholds:
+                break
+            if id not in self.pack_config and self.battery_stats.get(id, False) is not False:
+                if self.read_bms_config(id):
+                    self.apply_config(self.battery_stats[id], id)
+
+        self.timed_rollup(log_failed=True)
+        if not self.verify_pending:
+            self.save_state(self.battery_stats)
         return True
 
     def refresh_data(self):
         # call all functions that will refresh the battery data.
         # This will be called for every iteration (1 second)
         # Return True if success, False for failure
-        result = self.read_battery_bank()
+        if self.threaded or self.chains:
+            result = self.read_bank_snapshot()
+        else:
+            result = self.read_battery_bank()
         if result is False:
             return False
         return True
 
     def read_gen_data(self):
-        result = self.read_battery_bank()
-        if result is False:
-            return False
-        return True
+        return self.refresh_data()
 
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
 
     def discovery_pack(self):
-        bmsId = 1
         bmsChain = {}
         if not self.batteryPackId:
-            while bmsId <= 16:
-                attempts = 0
-                while attempts < 3:
-                    reply = self.read_serial_data_eg4_ll(self.commands[bmsId]["HW"])
-                    if reply is not False:
-                        bmsChain.update({bmsId : True})
-                        break
-                    attempts += 1
-                    #sleep(3)
-                bmsId += 1
+            bmsChain = self.verify_topology()
+            if not bmsChain:
+                bmsChain = self.scan_chain()
+                self.save_topology(bmsChain)
+            # Master first, then the slaves in ID order
+            self.batteryPackId = sorted(bmsChain, key=lambda bmsId: (bmsId != 16, bmsId))
         else:
             for Id in self.batteryPackId:
                 attempts = 0
                 while attempts < 1:
-                    reply = self.read_serial_data_eg4_ll(self.commands[Id]["HW"])
+                    if self.wide_read:
+                        # The probe already carries everything get_settings needs, keep it
+                        reply = self.read_pack_details(Id)
+                        if reply is not False:
+                            self.battery_stats[Id] = reply
+                    else:
+                        reply = self.read_serial_data_eg4_ll(self.commands[Id]["HW"])
                     if reply is not False:
                         bmsChain.update({Id : True})
                         break
                     attempts += 1
-                    #sleep(3)
-                bmsId += 1
 
         logger.info(f"Connected to BMS ID's: {pformat(bmsChain)}")
         return bmsChain
 
-    def read_hw_details(self, id):
-        battery = {}
-        result = self.read_serial_data_eg4_ll(self.commands[id]["HW"])
+    def probe_pack(self, id):
+        # HW identity of one pack with the short discovery timeout, False if nothing answers
+        attempts = 0
+        while attempts < self.discovery_attempts:
+            result = self.read_serial_data_eg4_ll(self.commands[id]["HW"], probe=True)
+            if result is not False:
+                return self.decode_hw_details(id, result)
+            attempts += 1
+        return False
+
+    def scan_chain(self):
+        bmsChain = {}
+        for bmsId in range(1, 17):
+            reply = self.probe_pack(bmsId)
+            if reply is not False:
+                bmsChain.update({bmsId : reply["hw_serial"]})
+        return bmsChain
+
+    def verify_topology(self):
+        # One pass over the cached chain, every pack has to answer with the serial it had when cached
+        cached = self.load_topology()
+        if not cached:
+            return {}
+        for bmsId, serial_number in cached.items():
+            reply = self.probe_pack(bmsId)
+            if reply is False or reply["hw_serial"] != serial_number:
+                logger.info(f"Cached BMS chain does not match at ID:{bmsId}, scanning all ID's")
+                return {}
+        return cached
+
+    def warm_start(self):
+        # Publish the persisted chain after one CELL read of the master, the first sweep verifies the rest
+        packs = self.load_state()
+        if 16 not in packs:
+            return False
+        if self.batteryPackId and set(self.batteryPackId) != set(packs):
+            return False
+        reply = self.read_cell_details(16)
+        if reply is False:
+            return False
+        packs[16] = reply.update_hw(packs[16])
+        self.auto_discovery = not self.batteryPackId
+        self.battery_stats = packs
+        self.batteryPackId = sorted(packs, key=lambda bmsId: (bmsId != 16, bmsId))
+        self.warm_packs = set(packs) - {16}
+        self.verify_pending = True
+        if self.rollupBatteryBank(self.battery_stats) == "Failed":
+            self.warm_packs = set()
+            self.verify_pending = False
+            return False
+        logger.info(f"Warm start from {self.state_file}: BMS ID's {self.batteryPackId}, verifying on the first poll")
+        return True
+
+    def verify_sweep(self, battery_stats):
+        # End of the first sweep after a warm start: every pack has been read in full once
+        self.verify_pending = False
+        self.warm_packs = set()
+        if self.auto_discovery:
+            # Chain found by discovery, pick up packs added since the state was saved
+            for bmsId in range(1, 17):
+                if bmsId not in self.batteryPackId and self.probe_pack(bmsId) is not False:
+                    reply = self.read_pack_details(bmsId)
+                    if reply is not False:
+                        logger.info(f"BMS ID:{bmsId} joined the chain since the last start")
+                        battery_stats[bmsId] = reply
+                        self.batteryPackId = self.batteryPackId + [bmsId]
+            self.save_topology({
+                bmsId : battery_stats[bmsId].hw_serial
+                for bmsId in self.batteryPackId if battery_stats.get(bmsId, False) is not False
+            })
+        self.save_state(battery_stats)
+
+    def load_state(self):
+        if not self.state_file:
+            return {}
+        try:
+            with open(self.state_file, "r") as file:
+                state = json.load(file)[self.port]
+            age = max(0.0, time() - state["saved"])
+            return {int(bmsId) : snapshot_from_state(pack, age) for bmsId, pack in state["packs"].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return {}
+
+    def save_state(self, battery_stats):
+        # Rewritten through a temporary file so a power cut never leaves half a file behind
+        self.state_saved = monotonic()
+        if not self.state_file:
+            return
+        packs = {
+            bmsId : snapshot_state(snapshot) for bmsId, snapshot in battery_stats.items()
+            if snapshot is not False and snapshot.hw_serial is not None and bmsId not in self.warm_packs
+        }
+        if not packs:
+            return
+        with STATE_LOCK:
+            try:
+                with open(self.state_file, "r") as file:
+                    state = json.load(file)
+            except (OSError, ValueError):
+                state = {}
+            state[self.port] = {"saved" : time(), "packs" : packs}
+            try:
+                with open(self.state_file + ".tmp", "w") as file:
+                    json.dump(state, file)
+                os.replace(self.state_file + ".tmp", self.state_file)
+            except OSError as e:
+                logger.error(f"Unable to save BMS state to {self.state_file}: {e}")
+
+    def load_topology(self):
+        try:
+            with open(self.topology_file, "r") as file:
+                topology = json.load(file)
+            return {int(bmsId) : serial_number for bmsId, serial_number in topology[self.port].items()}
+        except (OSError, ValueError, KeyError, AttributeError):
+            return {}
+
+    def save_topology(self, bmsChain):
+        # Chains are discovered in parallel and share the file, same locking and replace as save_state
+        if not bmsChain:
+            return
+        with STATE_LOCK:
+            try:
+                with open(self.topology_file, "r") as file:
+                    topology = json.load(file)
+            except (OSError, ValueError):
+                topology = {}
+            topology[self.port] = bmsChain
+            try:
+                with open(self.topology_file + ".tmp", "w") as file:
+                    json.dump(topology, file)
+                os.replace(self.topology_file + ".tmp", self.topology_file)
+            except OSError as e:
+                logger.error(f"Unable to save BMS chain to {self.topology_file}: {e}")
+
+    def read_pack_details(self, id, probe=False):
+        # HW identity and CELL stats of one pack, with a single wide read when the BMS accepts it.
+        # Only an exception reply rejects the wide read, a missed reply is just a missed reply.
+        if self.wide_read and id not in self.wide_read_rejected:
+            frame = self.read_serial_data_eg4_ll(self.commands[id]["WIDE"], probe)
+            if frame is not False:
+                return self.decode_wide_details(id, frame)
+            if self.last_exception is None:
+                return False
+            self.wide_read_rejected.add(id)
+            logger.info(f"BMS ID:{id} rejected the wide read, using separate HW and CELL reads")
+
+        hw_reply = self.read_hw_details(id, probe)
+        cell_reply = self.read_cell_details(id, probe)
+        if hw_reply is False or cell_reply is False:
+            return False
+        return cell_reply.update_hw(hw_reply)
+
+    def decode_wide_details(self, id, frame):
+        span_start = register_span(WIDE_BLOCKS)[0]
+        hw_reply = self.decode_hw_details(id, split_frame(frame, span_start, "HW"))
+        cell_reply = self.decode_cell_details(split_frame(frame, span_start, "CELL"))
+        return cell_reply.update_hw(hw_reply)
+
+    def read_hw_details(self, id, probe=False):
+        result = self.read_serial_data_eg4_ll(self.commands[id]["HW"], probe)
         if result is False:
             return False
+        return self.decode_hw_details(id, result)
 
+    def decode_hw_details(self, id, result):
+        battery = {}
         battery.update({"hw_make" : result[2:25].decode("utf-8")})
         battery.update({"hw_version" : result[27:33].decode("utf-8")})
         battery.update({"hw_serial" : (result[33:48].decode("utf-8")+"_"+str(id))})
@@ -237,53 +2188,28 @@ class EG4_LL(Battery):
 
         return battery
 
-    def read_cell_details(self, id):
+    def read_cell_details(self, id, probe=False):
 
-        battery = {}
-        packet = self.read_serial_data_eg4_ll(self.commands[id]["CELL"])
+        packet = self.read_serial_data_eg4_ll(self.commands[id]["CELL"], probe)
+        if packet is False:
+            return False
+        return self.decode_cell_details(packet)
+
+    def read_fast_details(self, id, previous, probe=False):
+        packet = self.read_serial_data_eg4_ll(self.commands[id]["FAST"], probe)
         if packet is False:
             return False
+        battery = decode_fast_frame(packet, previous)
+        battery.balancing_code, battery.balancing_text = self.status_balancing(
+            battery.cell_max, battery.cell_min, self.pack_config.get(id)
+        )
+        return battery
 
-        battery.update({"voltage" : int.from_bytes(packet[3:5], "big") / 100})
-        battery.update({"current" : int.from_bytes(packet[5:7], "big", signed=True) / 100})
-        battery.update({"capacity_remain" : int.from_bytes(packet[45:47], "big")})
-        battery.update({"capacity" : int.from_bytes(packet[65:69], "big") / 3600 / 1000})
-        battery.update({"max_battery_charge_current" : int.from_bytes(packet[47:49], "big")})
-        battery.update({"soc" : int.from_bytes(packet[51:53], "big")})
-        battery.update({"soh" : int.from_bytes(packet[49:51], "big")})
-        battery.update({"cycles" : int.from_bytes(packet[61:65], "big")})
-        battery.update({"temp1" : int.from_bytes(packet[39:41], "big", signed=True)})
-        battery.update({"temp2" : int.from_bytes(packet[69:70], "big", signed=True)})
-        battery.update({"temp_mos" : int.from_bytes(packet[70:71], "big", signed=True)})
-        battery.update({"temp_max" : max(battery["temp1"], battery["temp2"])})
-        battery.update({"temp_min" : min(battery["temp1"], battery["temp2"])})
-        battery.update({"cell_count" : int.from_bytes(packet[75:77], "big")})
-        battery.update({"status_hex" : packet[54:55].hex().upper()})
-        battery.update({"warning_hex" : packet[55:57].hex().upper()})
-        battery.update({"protection_hex" : packet[57:59].hex().upper()})
-        battery.update({"error_hex" : packet[59:61].hex().upper()})
-        battery.update({"heater_status" : packet[53:54].hex().upper()})
-        startByte = 7
-        endByte = 9
-        cellId = 1
-        cellVoltageList = []
-        cellVoltageSum = 0
-        while cellId <= battery["cell_count"]:
-            cellNum = "cell"+str(cellId)
-            cellVolt = int.from_bytes(packet[startByte:endByte], "big")/1000
-            battery.update({cellNum : cellVolt})
-            cellVoltageSum += float(battery[cellNum])
-            cellVoltageList.append(battery.get(cellNum))
-            startByte += 2
-            endByte += 2
-            cellId += 1
-        battery.update({"cell_voltage" : cellVoltageSum})
-        battery.update({"cell_max" : max(cellVoltageList)})
-        battery.update({"cell_min" : min(cellVoltageList)})
-        balancing_code = self.status_balancing(battery["cell_max"], battery["cell_min"], "code")
-        balancing_text = self.status_balancing(battery["cell_max"], battery["cell_min"], "text")
-        battery.update({"balancing_code" : balancing_code})
-        battery.update({"balancing_text" : balancing_text})
+    def decode_cell_details(self, packet):
+        battery = decode_cell_frame(packet)
+        battery.balancing_code, battery.balancing_text = self.status_balancing(
+            battery.cell_max, battery.cell_min, self.pack_config.get(packet[0])
+        )
         return battery
 
     def rollupBatteryBank(self, batteryBankStats):
@@ -291,88 +2217,72 @@ class EG4_LL(Battery):
         if self.battery_stats is False or self.battery_stats[16] is False:
             return "Failed"
 
-        #logger.info(f"batteryBankStats: {pformat(batteryBankStats)}")
-        self.voltage = self.battery_stats[16]["cell_voltage"]
-        self.current = self.battery_stats[16]["current"]
-        self.capacity_remain = self.battery_stats[16]["capacity_remain"]
-        self.capacity = self.battery_stats[16]["capacity"]
-        self.soc = self.battery_stats[16]["soc"]
-        self.soh = self.battery_stats[16]["soh"]
-        self.cycles = self.battery_stats[16]["cycles"]
-        self.temp1 = self.battery_stats[16]["temp1"]
-        self.temp2 = self.battery_stats[16]["temp2"]
-        self.temp_mos = self.battery_stats[16]["temp_mos"]
-        #self.serial_number = batteryBankStats[16]["hw_serial"]
-        #self.version = batteryBankStats[16]["hw_make"]
-        #self.hardware_version = batteryBankStats[16]["hw_version"]
-        self.lookup_protection(self.battery_stats)
-        self.lookup_warning(self.battery_stats)
-
-        if len(self.battery_stats) > 1:
-            for bmsId in self.battery_stats:
-                if bmsId != 16:
-                    if bmsId != False:
-                        if self.battery_stats[bmsId] is not False:
-                            self.voltage = (self.voltage + self.battery_stats[bmsId]["cell_voltage"]) / 2
-                            self.current = round((self.current + self.battery_stats[bmsId]["current"]), 2)
-                            self.capacity_remain = (self.capacity_remain + self.battery_stats[bmsId]["capacity_remain"])
-                            self.capacity = (self.capacity + self.battery_stats[bmsId]["capacity"])
-                            self.soc = (self.soc + self.battery_stats[bmsId]["soc"]) / 2
-                            self.soh = (self.soh + self.battery_stats[bmsId]["soh"]) / 2
-                            if self.battery_stats[bmsId]["cycles"] > self.cycles:
-                                self.cycles = self.battery_stats[bmsId]["cycles"]
-                            if self.battery_stats[bmsId]["temp1"] > self.temp1:
-                                self.temp1 = self.battery_stats[bmsId]["temp1"]
-                            if self.battery_stats[bmsId]["temp2"] > self.temp2:
-                                self.temp2 = self.battery_stats[bmsId]["temp2"]
-                            if self.battery_stats[bmsId]["temp_mos"] > self.temp_mos:
-                                self.temp_mos = self.battery_stats[bmsId]["temp_mos"]
+        # Packs that missed their last poll keep publishing their last good snapshot, flagged with its age
+        now = monotonic()
+        self.stale_packs = {}
+        for bmsId in self.battery_stats:
+            health = self.get_pack_health(bmsId)
+            if health is not None and health.state != PACK_HEALTHY and self.battery_stats[bmsId] is not False:
+                self.stale_packs[bmsId] = round(self.battery_stats[bmsId].age(now), 1)
+            elif self.is_warm(bmsId) and self.battery_stats[bmsId] is not False:
+                self.stale_packs[bmsId] = round(self.battery_stats[bmsId].age(now), 1)
+
+        changed = False
+        for bmsId in self.battery_stats:
+            if self.battery_stats[bmsId] is not False:
+                changed |= self.bank.update(bmsId, self.battery_stats[bmsId])
+            else:
+                changed |= self.bank.remove(bmsId)
+        if not changed and self.bank.result is not None:
+            return True
+
+        bank = self.bank.aggregate()
+        self.voltage = bank["voltage"]
+        self.current = round(bank["current"], 2)
+        self.capacity_remain = bank["capacity_remain"]
+        self.capacity = bank["capacity"]
+        self.soc = bank["soc"]
+        self.soh = bank["soh"]
+        self.cycles = bank["cycles"]
+        self.temp1 = bank["temp1"]
+        self.temp2 = bank["temp2"]
+        self.temp_mos = bank["temp_mos"]
+        self.set_alarms(*bank["alarms"])
 
         self.temp_max = max(self.temp1, self.temp2)
         self.temp_min = min(self.temp1, self.temp2)
-        self.cell_count = batteryBankStats[16]["cell_count"]
+        self.cell_count = batteryBankStats[16].cell_count
         self.min_battery_voltage = float(utils.MIN_CELL_VOLTAGE * self.cell_count)
         self.max_battery_voltage = float(utils.MAX_CELL_VOLTAGE * self.cell_count)
 
+        # Packs are in parallel, the published string is the master's cells. Min / max cover every pack.
         if len(self.cells) != self.cell_count:
             self.cells = []
             for idx in range(self.cell_count):
                 self.cells.append(Cell(False))
 
-        self.cells[0].voltage = self.battery_stats[16]["cell1"]
-        self.cells[1].voltage = self.battery_stats[16]["cell2"]
-        self.cells[2].voltage = self.battery_stats[16]["cell3"]
-        self.cells[3].voltage = self.battery_stats[16]["cell4"]
-        #self.cells[4].voltage = batteryBankStats[1]["cell1"]
-        #self.cells[5].voltage = batteryBankStats[1]["cell2"]
-        #self.cells[6].voltage = batteryBankStats[1]["cell3"]
-        #self.cells[7].voltage = batteryBankStats[1]["cell4"]
-
-
-        self.cell_min_voltage = min(self.cells[0].voltage, self.cells[1].voltage,
-                                    self.cells[2].voltage, self.cells[3].voltage)
-                #                    self.cells[4].voltage, self.cells[5].voltage,
-                #                    self.cells[6].voltage, self.cells[7].voltage)
-        self.cell_max_voltage = max(self.cells[0].voltage, self.cells[1].voltage,
-                                    self.cells[2].voltage, self.cells[3].voltage)
-                #                    self.cells[4].voltage, self.cells[5].voltage,
-                #                    self.cells[6].voltage, self.cells[7].voltage)
+        for idx, cellVolt in enumerate(self.bank.pack_cells(16, self.cell_count)):
+            self.cells[idx].voltage = cellVolt
+
+        self.cell_min_voltage = bank["cell_min"]
+        self.cell_max_voltage = bank["cell_max"]
+        self.cell_voltage_spread = bank["cell_spread"]
         return True
 
     def status_logger(self, batteryBankStats):
         if self.battery_stats is not False or self.battery_stats[16] is not False:
             logger.info("===== HW Info =====")
-            logger.info(f"Battery Make/Model: {self.battery_stats[16]['hw_make']}")
-            logger.info(f"Hardware Version: {self.battery_stats[16]['hw_version']}")
+            logger.info(f"Battery Make/Model: {self.battery_stats[16].hw_make}")
+            logger.info(f"Hardware Version: {self.battery_stats[16].hw_version}")
             for bmsId in self.battery_stats:
                 if self.battery_stats[bmsId] is not False:
-                    logger.info(f"Serial Number: {self.battery_stats[bmsId]['hw_serial']}")
+                    logger.info(f"Serial Number: {self.battery_stats[bmsId].hw_serial}")
             logger.info("===== Temp =====")
             logger.info(f"Temp 1: {self.temp1}c | Temp 2: {self.temp2}c | Temp Mos: {self.temp_mos}c")
             logger.info(f"Temp Max: {self.temp_max} | Temp Min: {self.temp_min}")
             for bmsId in self.battery_stats:
                 if self.battery_stats[bmsId] is not False:
-                    logger.info(f"Heater {bmsId} Status: {self.lookup_heater(self.battery_stats[bmsId]['heater_status'])}")
+                    logger.info(f"Heater {bmsId} Status: {self.lookup_heater(self.battery_stats[bmsId].heater_status)}")
             logger.info("===== DVCC State =====")
             logger.info(f"DVCC Charger Mode: {self.charge_mode}")
             logger.info(f"DVCC Charge Voltage: {self.control_voltage}v")
@@ -400,151 +2310,61 @@ class EG4_LL(Battery):
             logger.info("===== Pack Details =====")
             for bmsId in self.battery_stats:
                 if self.battery_stats[bmsId] is not False:
-                    cellId = 1
                     logger.info(f"  === BMS ID-{bmsId} ===")
-                    logger.info(f"  State: {self.lookup_status(self.battery_stats[bmsId]['status_hex'])}")
-                    logger.info(f"  Pack Balancing: {self.battery_stats[bmsId]['balancing_text']}")
-                    logger.info(f"  Pack Voltage: {round((self.battery_stats[bmsId]['cell_voltage']),3)}v | Pack Current: {round((self.battery_stats[bmsId]['current']),2)}a")
+                    if bmsId in self.stale_packs:
+                        # Packs taken from the state file have no health entry until their first poll
+                        health = self.get_pack_health(bmsId)
+                        state = health.state if health is not None else "warm start, unverified"
+                        logger.info(f"  Stale: last reply {self.stale_packs[bmsId]}s ago ({state})")
+                    logger.info(f"  State: {self.lookup_status(self.battery_stats[bmsId].status_hex)}")
+                    logger.info(f"  Pack Balancing: {self.battery_stats[bmsId].balancing_text}")
+                    config = self.get_pack_config(bmsId)
+                    if self.config_balancer_thresholds and config is not None and config.valid:
+                        logger.info(
+                            f"  Balancer: from {config.balancer_voltage}v, delta {config.balancer_delta}v | "
+                            f"Cell Protect: {config.cell_under_voltage_protect}v - {config.cell_over_voltage_protect}v"
+                        )
+                    logger.info(f"  Pack Voltage: {round((self.battery_stats[bmsId].cell_voltage),3)}v | Pack Current: {round((self.battery_stats[bmsId].current),2)}a")
                     logger.info("    = Cell Stats =")
-                    while cellId <= self.battery_stats[bmsId]['cell_count']:
-                        logger.info(f"  Cell {str(cellId)} Voltage: {self.battery_stats[bmsId]['cell'+str(cellId)]}")
-                        cellId += 1
-                    logger.info(f"  Cell Max/Min/Diff: ({self.battery_stats[bmsId]['cell_max']}/{self.battery_stats[bmsId]['cell_min']}/{round((self.battery_stats[bmsId]['cell_max'] - self.battery_stats[bmsId]['cell_min']), 3)})v")
+                    for cellId, cellVolt in enumerate(self.battery_stats[bmsId].cells, 1):
+                        logger.info(f"  Cell {cellId} Voltage: {cellVolt}")
+                    logger.info(f"  Cell Max/Min/Diff: ({self.battery_stats[bmsId].cell_max}/{self.battery_stats[bmsId].cell_min}/{round((self.battery_stats[bmsId].cell_max - self.battery_stats[bmsId].cell_min), 3)})v")
         return True
 
-    def lookup_warning(self, batteryBankStats):
-
-        unique_codes = []
+    def alarm_masks(self, batteryBankStats):
+        # Union of the warning, protection and error bits of every pack
+        warning = protection = error = 0
         for bmsId in batteryBankStats:
             if batteryBankStats[bmsId] is not False:
-                if batteryBankStats[bmsId]["warning_hex"] not in unique_codes:
-                    unique_codes.append(batteryBankStats[bmsId]["warning_hex"])
-        warning_alarm = ""
-        for code in unique_codes:
-            if code == "0000":
-                warning_alarm += "No Warnings - "+code
-            elif code == "0001":
-                warning_alarm += "Warning: "+code+" - Pack Over Voltage"
-                self.voltage_high = 1
-            elif code == "0002":
-                warning_alarm += "Warning: "+code+" - Cell Over Voltage"
-                self.voltage_cell_high = 1
-            elif code == "0004":
-                warning_alarm += "Warning: "+code+" - Pack Under Voltage"
-                self.voltage_low = 1
-            elif code == "0008":
-                warning_alarm += "Warning: "+code+" - Cell Under Voltage"
-                self.voltage_cell_low = 1
-            elif code == "0010":
-                warning_alarm += "Warning: "+code+" - Charge Over Current"
-                self.current_over = 1
-            elif code == "0020":
-                warning_alarm += "Warning: "+code+" - Discharge Over Current"
-                self.current_over = 1
-            elif code == "0040":
-                warning_alarm += "Warning: "+code+" - Ambient High Temp"
-                self.temp_high_internal = 1
-            elif code == "0080":
-                warning_alarm += "Warning: "+code+" - Mosfets High Temp"
-                self.temp_high_internal = 1
-            elif code == "0100":
-                warning_alarm += "Warning: "+code+" - Charge Over Temp"
-                self.temp_high_charge = 1
-            elif code == "0200":
-                warning_alarm += "Warning: "+code+" - Discharge Over Temp"
-                self.temp_high_discharge = 1
-            elif code == "0400":
-                warning_alarm += "Warning: "+code+" - Charge Under Temp"
-                self.temp_low_charge = 1
-            elif code == "1000":
-                warning_alarm += "Warning: "+code+" - Low Capacity"
-                self.soc_low = 1
-            elif code == "2000":
-                warning_alarm += "Warning: "+code+" - Float Stoped"
-            elif code == "4000":
-                warning_alarm += "Warning: "+code+" - UNKNOWN"
-                self.internal_failure = 1
+                warning |= batteryBankStats[bmsId].warning_hex
+                protection |= batteryBankStats[bmsId].protection_hex
+                error |= batteryBankStats[bmsId].error_hex
+        return warning, protection, error
+
+    def update_alarms(self, batteryBankStats):
+        self.set_alarms(*self.alarm_masks(batteryBankStats))
+
+    def set_alarms(self, warning, protection, error):
+        # 2 when a protection bit for the alarm is set on any pack, 1 for a warning bit, else 0
+        self.alarm_warning = warning
+        self.alarm_protection = protection
+        self.alarm_error = error
+        for attribute in ALARM_ATTRIBUTES:
+            if protection & PROTECTION_MASKS.get(attribute, 0):
+                setattr(self, attribute, 2)
+            elif warning & WARNING_MASKS.get(attribute, 0):
+                setattr(self, attribute, 1)
             else:
-                warning_alarm += "Warning: "+code+" - UNKNOWN"
+                setattr(self, attribute, 0)
 
-        return warning_alarm
+    def lookup_warning(self, batteryBankStats):
+        return alarm_text(self.alarm_masks(batteryBankStats)[0], WARNING_BITS, "Warning", "No Warnings")
 
     def lookup_protection(self, batteryBankStats):
-        unique_codes = []
-        for bmsId in batteryBankStats:
-            if batteryBankStats[bmsId] is not False:
-                if batteryBankStats[bmsId]["protection_hex"] not in unique_codes:
-                    unique_codes.append(batteryBankStats[bmsId]["protection_hex"])
-        protection_alarm = ""
-        for code in unique_codes:
-            if code == "0000":
-                protection_alarm += "No Protection Events - "+code
-            elif code == "0001":
-                protection_alarm += "Protection: "+code+" - Pack Over Voltage"
-                self.voltage_high = 2
-            elif code == "0002":
-                protection_alarm += "Protection: "+code+" - Cell Over Voltage"
-                self.voltage_cell_high = 2
-            elif code == "0004":
-                protection_alarm += "Protection: "+code+" - Pack Under Voltage"
-                self.voltage_low = 2
-            elif code == "0008":
-                protection_alarm += "Protection: "+code+" - Cell Under Voltage"
-                self.voltage_cell_low = 2
-            elif code == "0010":
-                protection_alarm += "Protection: "+code+" - Charge Over Current"
-                self.current_over = 2
-            elif code == "0020":
-                protection_alarm += "Protection: "+code+" - Discharge Over Current"
-                self.current_over = 2
-            elif code == "0040":
-                protection_alarm += "Protection: "+code+" - High Ambient Temp"
-                self.temp_high_internal = 2
-            elif code == "0080":
-                protection_alarm += "Protection: "+code+" - Mosfets High Temp"
-                self.temp_high_internal = 2
-            elif code == "0100":
-                protection_alarm += "Protection: "+code+" - Charge Over Temp"
-                self.temp_high_charge = 2
-            elif code == "0200":
-                protection_alarm += "Protection: "+code+" - Discharge Over Temp"
-                self.temp_high_discharge = 2
-            elif code == "0400":
-                protection_alarm += "Protection: "+code+" - Charge Under Temp"
-                self.temp_low_charge = 2
-            elif code == "0800":
-                protection_alarm += "Protection: "+code+" - Discharge Under Temp"
-                self.temp_low_charge = 2
-            elif code == "1000":
-                protection_alarm += "Protection: "+code+" - Low Capacity"
-                self.soc_low = 2
-            elif code == "2000":
-                protection_alarm += "Protection: "+code+" - Discharge SC"
-            else:
-                protection_alarm += "UNKNOWN: "+code
-        return protection_alarm
+        return alarm_text(self.alarm_masks(batteryBankStats)[1], PROTECTION_BITS, "Protection", "No Protection Events")
 
     def lookup_error(self, batteryBankStats):
-        unique_codes = []
-        for bmsId in batteryBankStats:
-            if batteryBankStats[bmsId] is not False:
-                if batteryBankStats[bmsId]["error_hex"] not in unique_codes:
-                    unique_codes.append(batteryBankStats[bmsId]["error_hex"])
-        error_alarm = ""
-        for code in unique_codes:
-            if code == "0000":
-                error_alarm = f"No Errors - "+code
-            elif code == "0001":
-                error_alarm = f"Error: "+code+" - Voltage Error"
-            elif code == "0002":
-                error_alarm = f"Error: "+code+" - Temperature Error"
-            elif code == "0004":
-                error_alarm = f"Error: "+code+" - Current Flow Error"
-            elif code == "0010":
-                error_alarm = f"Error: "+code+" - Cell Unbalanced"
-            else:
-                error_alarm = "UNKNOWN: "+code
-        return error_alarm
+        return alarm_text(self.alarm_masks(batteryBankStats)[2], ERROR_BITS, "Error", "No Errors")
 
     def lookup_status(self, status_hex):
         if status_hex == "00":
@@ -566,9 +2386,15 @@ class EG4_LL(Battery):
             heater_state = True
         return heater_state
 
-    def status_balancing(self, cell_max, cell_min, reply):
-        balancer_current_delta = .40
-        balancer_voltage = 3.40
+    def status_balancing(self, cell_max, cell_min, config=None):
+        # (state, text) from the pack's own balancer settings when its CONFIG has been read and
+        # config_balancer_thresholds is on, from the defaults otherwise
+        if self.config_balancer_thresholds and config is not None and config.valid:
+            balancer_current_delta = config.balancer_delta
+            balancer_voltage = config.balancer_voltage
+        else:
+            balancer_current_delta = DEFAULT_BALANCER_DELTA
+            balancer_voltage = DEFAULT_BALANCER_VOLTAGE
         balacing_state = 0
         balacing_text = ""
         if (cell_max > balancer_voltage) and (round((cell_max - cell_min), 3) <= balancer_current_delta):
@@ -581,37 +2407,364 @@ class EG4_LL(Battery):
         else:
             balacing_state = 0
             balacing_text = "Off"
-
-        if reply == "text":
-            return balacing_text
-        elif reply == "code":
-            return balacing_state
-        else:
-            return False
+        return balacing_state, balacing_text
 
     def read_battery_bank(self):
+        self.poll_battery_bank(self.battery_stats)
+        result = self.timed_rollup()
+        self.publish_metrics(self.battery_stats)
+        self.log_metrics()
+        return True
+        #return False
+
+    def timed_rollup(self, log_failed=False):
+        # log_failed: log the status in the configured format after a failed rollup even with statuslogger off
+        started = monotonic()
+        result = self.rollupBatteryBank(self.battery_stats)
+        finished = monotonic()
+        self.metrics.phase(PHASE_ROLLUP, finished - started)
+        if self.statuslogger is True or (log_failed and result == "Failed"):
+            if self.status_format == "diff":
+                self.status_diff_logger(self.battery_stats)
+            else:
+                self.status_logger(self.battery_stats)
+            self.metrics.phase(PHASE_STATUS_LOGGER, monotonic() - finished)
+        return result
+
+    def status_diff_logger(self, batteryBankStats):
+        # One JSON line per sweep, nothing is compared or formatted unless INFO is enabled
+        if not logger.isEnabledFor(logging.INFO) or self.battery_stats is False or self.battery_stats.get(16, False) is False:
+            return
+        if self.status_diff is None:
+            self.status_diff = StatusDiff(self.status_snapshot_interval)
+        record = self.status_diff.record(self, batteryBankStats, monotonic())
+        if record is not None:
+            logger.info(f"EG4_LL status {json.dumps(record, separators=(',', ':'))}")
+
+    def log_metrics(self):
+        if self.metrics_log_interval and monotonic() - self.metrics_logged >= self.metrics_log_interval:
+            self.metrics_logged = monotonic()
+            logger.info(self.metrics.summary())
+
+    def publish_metrics(self, battery_stats):
+        # Called once per completed sweep, renders the exporter payload if the exporter is on
+        if not self.exporter_port:
+            return
+        try:
+            if self.exporter is None:
+                self.exporter = MetricsExporter(self.exporter_address, self.exporter_port)
+                logger.info(f"Metrics exporter listening on {self.exporter_address}:{self.exporter_port}")
+            self.exporter.publish(render_metrics(self, battery_stats))
+        except OSError as error:
+            logger.error(f"Metrics exporter disabled: {error}")
+            self.exporter_port = None
+
+    def get_bus_metrics(self):
+        # Request / error counters and latency histograms per BMS ID and command, plus phase timings
+        metrics = self.metrics.snapshot()
+        metrics["reopens"] = self.bus.reopen_count
+        metrics["bytes_written"] = self.bus.bytes_written
+        metrics["bytes_read"] = self.bus.bytes_read
+        metrics["dropped_bytes"] = self.bus.dropped_bytes
+        if self.chains:
+            metrics["chains"] = {chain.port : chain.get_bus_metrics() for chain in self.chains}
+        return metrics
+
+    def poll_battery_bank(self, battery_stats):
+        # One sweep over the chain, new snapshots are written into battery_stats
+        sweep_started = monotonic()
+        io_before = self.metrics.io_time
+        pace = 0.0
+        plan = self.scheduler.plan(self.batteryPackId)
+        verify = self.verify_pending
+        if verify:
+            # Everything the warm start took from the state file is read again
+            tasks = ["CELL", "HW", "CONFIG"] if self.config_balancer_thresholds else ["CELL", "HW"]
+            plan = {bmsId : tasks for bmsId in self.batteryPackId}
         id = 1
         for id in self.batteryPackId:
-            dataPacket = self.read_cell_details(id)
-            if dataPacket is not False: # if True
-                self.battery_stats[id] = { **self.battery_stats[id], **dataPacket }
-            sleep(.2)
+            health = self.pack_health.setdefault(id, PackHealth())
+            now = monotonic()
+            if not health.should_poll(now):
+                continue
+            # Packs that already missed a reply are read with the short probe timeout
+            probe = health.state != PACK_HEALTHY
+            previous = battery_stats.get(id, False)
+            tasks = plan[id]
+            if previous is False or "CELL" in tasks:
+                # FAST only refreshes part of a snapshot, the full CELL block covers it
+                tasks = ["CELL"] + [name for name in tasks if name not in ("FAST", "CELL")]
+            if self.wide_read and id not in self.wide_read_rejected and "CELL" in tasks and "HW" in tasks:
+                # Identity and stats both due: one wide read instead of two requests
+                tasks = ["WIDE"] + [name for name in tasks if name not in ("CELL", "HW")]
+
+            answered = True
+            for name in tasks:
+                if name == "FAST":
+                    dataPacket = self.read_fast_details(id, previous, probe)
+                elif name == "CELL":
+                    dataPacket = self.read_cell_details(id, probe)
+                    if dataPacket is not False and previous is not False:
+                        dataPacket.update_hw(previous)
+                elif name == "WIDE":
+                    dataPacket = self.read_pack_details(id, probe)
+                    if dataPacket is not False and previous is not False:
+                        self.check_hw_serial(id, previous.hw_serial, dataPacket.hw_serial)
+                elif name == "HW":
+                    dataPacket = self.read_hw_details(id, probe)
+                    if dataPacket is not False and battery_stats.get(id, False) is not False:
+                        self.check_hw_serial(id, battery_stats[id].hw_serial, dataPacket["hw_serial"])
+                        dataPacket = battery_stats[id].copy().update_hw(dataPacket)
+                    else:
+                        dataPacket = False
+                else:
+                    if self.read_bms_config(id, probe) and battery_stats.get(id, False) is not False:
+                        self.apply_config(battery_stats[id], id)
+                    continue
+                if dataPacket is False:
+                    answered = False
+                    break
+                battery_stats[id] = dataPacket
+                if self.history is not None and name != "HW":
+                    self.history.record(id, dataPacket)
+                if self.cell_health is not None and name != "HW":
+                    self.cell_health.update(id, dataPacket)
+
+            if answered:
+                if health.record_success() != PACK_HEALTHY:
+                    logger.info(f"BMS ID:{id} is answering again")
+            else:
+                previousState = health.record_failure(
+                    now, self.quarantine_after, self.quarantine_backoff, self.quarantine_backoff_max
+                )
+                if health.state == PACK_QUARANTINED and previousState != PACK_QUARANTINED:
+                    logger.error(f"BMS ID:{id} quarantined after {health.failures} missed replies")
+            pace_started = monotonic()
+            self.run_writes(pace_started + .2)
+            remaining = .2 - (monotonic() - pace_started)
+            if remaining > 0:
+                sleep(remaining)
+            pace += monotonic() - pace_started
             id+=1
-        result = self.rollupBatteryBank(self.battery_stats)
-        if self.statuslogger is True:
-            self.status_logger(self.battery_stats)
+        self.metrics.phase(PHASE_SWEEP, monotonic() - sweep_started)
+        self.metrics.phase(PHASE_IO, self.metrics.io_time - io_before)
+        self.metrics.phase(PHASE_PACE, pace)
+        if verify:
+            self.verify_sweep(battery_stats)
+        elif self.state_save_interval and monotonic() - self.state_saved >= self.state_save_interval:
+            self.save_state(battery_stats)
+        return battery_stats
+
+    def check_hw_serial(self, id, oldSerial, newSerial):
+        # A pack swapped under the same BMS ID keeps nothing read from the old one
+        if oldSerial is not None and oldSerial != newSerial:
+            logger.warning(f"BMS ID:{id} serial changed from {oldSerial} to {newSerial}")
+            if self.pack_config.pop(id, None) is not None:
+                self.config_generation += 1
+
+    def start_poller(self):
+        for chain in self.chains:
+            chain.start_poller()
+        if self.poller is not None and self.poller.is_alive():
+            return
+        self.bank_front = dict(self.battery_stats)
+        self.bank_time = monotonic()
+        self.poller_stop.clear()
+        self.poller = threading.Thread(target=self.poller_loop, name="EG4_LL poller", daemon=True)
+        self.poller.start()
+
+    def stop_poller(self):
+        for chain in self.chains:
+            chain.stop_poller()
+        self.poller_stop.set()
+        if self.poller is not None:
+            self.poller.join()
+            self.poller = None
+
+    def poller_loop(self):
+        # Owns the bus while threaded mode is on. Each sweep fills a back buffer
+        # started from the published snapshots, then publishes it in one
+        # reference swap, so readers always see a complete sweep.
+        while not self.poller_stop.is_set():
+            started = monotonic()
+            try:
+                back = self.poll_battery_bank(dict(self.bank_front))
+                self.bank_front = back
+                self.bank_time = monotonic()
+                self.publish_metrics(self.merge_chains(back))
+            except Exception:
+                (
+                    exception_type,
+                    exception_object,
+                    exception_traceback,
+                ) = sys.exc_info()
+                file = exception_traceback.tb_frame.f_code.co_filename
+                line = exception_traceback.tb_lineno
+                logger.error(
+                    f"Exception occurred: {repr(exception_object)} of type {exception_type} in {file} line #{line}"
+                )
+            self.poller_stop.wait(max(0, self.poller_interval - (monotonic() - started)))
+
+    def replay_capture(self, path, callback=None):
+        # Feed a capture file through the decoders and the bank rollup without a serial port.
+        # callback(timestamp, self) is called after every rollup, one rollup per replayed sweep.
+        # Returns the number of replies decoded.
+        self.bus = ReplayBus()
+        self.capture = None
+        replay = FrameReplay(path)
+        records = iter(replay)
+        request = reply = None
+        decoded = 0
+        sweep = set()
+        try:
+            for timestamp, slave_id, request, reply in records:
+                name = command_name(request)
+                if len(reply) == 0 or name is None:
+                    continue
+                if name != "HW":
+                    if slave_id in sweep:
+                        # Second stats frame of a pack starts the next sweep, roll up the one just completed
+                        if 16 in self.battery_stats and self.rollupBatteryBank(self.battery_stats) is True and callback:
+                            callback(timestamp, self)
+                        sweep.clear()
+                    sweep.add(slave_id)
+                self.bus.reply = bytes(reply)
+                previous = self.battery_stats.get(slave_id, False)
+                if name == "HW":
+                    dataPacket = self.read_hw_details(slave_id)
+                    if dataPacket is not False and previous is not False:
+                        self.battery_stats[slave_id] = previous.copy().update_hw(dataPacket)
+                    continue
+                elif name == "CELL":
+                    dataPacket = self.read_cell_details(slave_id)
+                elif name == "FAST" and previous is not False:
+                    dataPacket = self.read_fast_details(slave_id, previous)
+                elif name == "WIDE":
+                    dataPacket = self.read_serial_data_eg4_ll(bytes(request))
+                    if dataPacket is not False:
+                        dataPacket = self.decode_wide_details(slave_id, dataPacket)
+                else:
+                    continue
+                if dataPacket is False:
+                    continue
+                if previous is not False:
+                    dataPacket.update_hw(previous)
+                self.battery_stats[slave_id] = dataPacket
+                decoded += 1
+            if 16 in self.battery_stats and self.rollupBatteryBank(self.battery_stats) is True and callback:
+                callback(None, self)
+        finally:
+            # The memoryviews have to be released before the map can be closed
+            request = reply = None
+            records.close()
+            replay.close()
+        return decoded
+
+    def get_history(self, bmsId, metric, seconds):
+        # min / max / mean / last of a pack metric ("voltage", "current", "soc", "temp1", "cell1", ...)
+        # over the last seconds, None when there is no sample in the window
+        chain, chainId = self.find_chain(bmsId)
+        if chain is None or chain.history is None:
+            return None
+        return chain.history.query(chainId, metric, seconds)
+
+    def get_cell_health(self, bmsId=None):
+        # Streaming cell analytics: {BMS ID : [per cell dict]} or the list of one pack, None when disabled
+        if bmsId is None:
+            ids = list(self.batteryPackId) + self.chain_pack_ids()
+            return {bmsId : self.get_cell_health(bmsId) for bmsId in ids}
+        chain, chainId = self.find_chain(bmsId)
+        if chain is None or chain.cell_health is None:
+            return None
+        return chain.cell_health.pack(chainId)
+
+    def get_bank_age(self):
+        # Seconds since the published snapshot was completed, the oldest one with several buses
+        return monotonic() - min([self.bank_time] + [chain.bank_time for chain in self.chains])
+
+    def connect_chains(self):
+        # Discovery and HW reads of every extra bus in parallel, a bus that fails is dropped with an error
+        def connect(chain):
+            chain.connected = chain.test_connection() and chain.get_settings()
+
+        threads = []
+        for chain in self.chains:
+            chain.connected = False
+            thread = threading.Thread(target=connect, args=(chain,), name=f"EG4_LL connect {chain.port}", daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        for chain in self.chains:
+            if not chain.connected:
+                logger.error(f"No EG4 LL chain on {chain.port}, polling continues without it")
+        self.chains = [chain for chain in self.chains if chain.connected]
+
+    def merge_chains(self, battery_stats):
+        # One bank out of the published sweep of every bus, extra buses keyed bus * 16 + BMS ID
+        if not self.chains:
+            return battery_stats
+        merged = dict(battery_stats)
+        for chain in self.chains:
+            offset = chain.bus_index * BANK_PACKS
+            for bmsId, snapshot in chain.bank_front.items():
+                merged[offset + bmsId] = snapshot
+        return merged
+
+    def chain_pack_ids(self):
+        return [chain.bus_index * BANK_PACKS + bmsId for chain in self.chains for bmsId in chain.batteryPackId]
+
+    def find_chain(self, bmsId):
+        # (EG4_LL polling the bank key, its BMS ID on that bus)
+        bus, row = divmod(bmsId - 1, BANK_PACKS)
+        if bus == 0:
+            return self, bmsId
+        for chain in self.chains:
+            if chain.bus_index == bus:
+                return chain, row + 1
+        return None, bmsId
+
+    def is_warm(self, bmsId):
+        # True while the pack only has data from the state file
+        chain, chainId = self.find_chain(bmsId)
+        return chain is not None and chainId in chain.warm_packs
+
+    def get_pack_health(self, bmsId):
+        chain, chainId = self.find_chain(bmsId)
+        if chain is None:
+            return None
+        return chain.pack_health.get(chainId)
+
+    def read_bank_snapshot(self):
+        self.start_poller()
+        self.battery_stats = self.merge_chains(self.bank_front)
+        result = self.timed_rollup()
+        self.log_metrics()
+        if result == "Failed":
+            return False
+        if self.get_bank_age() > self.bank_stale_after:
+            logger.error(f"No complete poll of the BMS chain for {round(self.get_bank_age(), 1)}s")
+            return False
         return True
-        #return False
 
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
 
     def get_balancing(self):
+        # Only recomputed when the bank or the CONFIG of a pack changed since the last call
+        key = (self.bank.generation, self.config_generation + sum(chain.config_generation for chain in self.chains))
+        if self.balancing_cache is not None and self.balancing_cache[0] == key:
+            self.balacing_text = self.balancing_cache[2]
+            return self.balancing_cache[1]
+        balacing_state = self.compute_balancing()
+        self.balancing_cache = (key, balacing_state, self.balacing_text)
+        return balacing_state
+
+    def compute_balancing(self):
         balancingSummery = []
-        for bmsId in self.batteryPackId:
+        for bmsId in self.batteryPackId + self.chain_pack_ids():
             if bmsId in self.battery_stats:
                 if self.battery_stats[bmsId] is not False:
-                    stateCode = self.status_balancing(self.battery_stats[bmsId]['cell_max'], self.battery_stats[bmsId]['cell_min'], "code")
-                    balancingSummery.append(stateCode)
+                    balancingSummery.append(self.battery_stats[bmsId].balancing_code)
                 else:
                     return 0
 
@@ -628,45 +2781,162 @@ class EG4_LL(Battery):
         return balacing_state
 
     def get_max_temp(self):
-        self.temp1 = self.battery_stats[16]["temp1"]
-        self.temp2 = self.battery_stats[16]["temp2"]
+        self.temp1 = self.battery_stats[16].temp1
+        self.temp2 = self.battery_stats[16].temp2
         temp_max = max(self.temp1, self.temp2)
         return temp_max
 
     def get_min_temp(self):
-        self.temp1 = self.battery_stats[16]["temp1"]
-        self.temp2 = self.battery_stats[16]["temp2"]
+        self.temp1 = self.battery_stats[16].temp1
+        self.temp2 = self.battery_stats[16].temp2
         temp_min = min(self.temp1, self.temp2)
         return temp_min
 
-    def read_bms_config(self):
-        logger.info("Executed read_bms_config function... function needs to be written")
+    def read_bms_config(self, id, probe=False):
+        # The block is only decoded again when its bytes changed since the last read
+        result = self.read_serial_data_eg4_ll(self.commands[id]["CONFIG"], probe)
+        if result is False:
+            return False
+        previous = self.pack_config.get(id)
+        if previous is not None and previous.raw == result[FRAME_HEADER_LENGTH:FRAME_HEADER_LENGTH + CONFIG_FRAME.size]:
+            previous.timestamp = monotonic()
+            return True
+        config = decode_config_frame(result)
+        self.pack_config[id] = config
+        self.config_generation += 1
+        if self.debug_config_hex:
+            logger.info(f'BMS ID:{id} Config: {result.hex(":").upper()}')
+        if self.debug_config:
+            logger.info(f"BMS ID:{id} Config: {pformat(config.limits())}")
+        if not config.valid:
+            logger.warning(f"BMS ID:{id} CONFIG does not look valid, using default balancer thresholds")
+        elif previous is not None:
+            logger.info(f"BMS ID:{id} CONFIG changed")
+        return True
+
+    def apply_config(self, snapshot, id):
+        # Balancing of the current snapshot follows a CONFIG read at once, not only from the next frame
+        snapshot.balancing_code, snapshot.balancing_text = self.status_balancing(
+            snapshot.cell_max, snapshot.cell_min, self.pack_config.get(id)
+        )
+
+    def get_pack_config(self, bmsId):
+        # Decoded CONFIG of a pack (thresholds and protection limits), None until it has been read.
+        # CONFIG is only read with config_balancer_thresholds on, the register map is unverified.
+        if not self.config_balancer_thresholds:
+            return None
+        chain, chainId = self.find_chain(bmsId)
+        if chain is None:
+            return None
+        return chain.pack_config.get(chainId)
+
+    def queue_write(self, bmsId, register, values, priority=1, callback=None):
+        # Queue holding register writes to one pack, sent between poll transactions and confirmed
+        # by a read back. Lower priority values go first. callback(bmsId, register, ok) per register.
+        if not self.writes_enabled:
+            logger.error(f"Write to BMS ID:{bmsId} register {register:04X} ignored, writes_enabled is off")
+            return False
+        chain, chainId = self.find_chain(bmsId)
+        if chain is None:
+            return False
+        chain.writes.put(chainId, register, values, priority, callback)
         return True
 
-    def generate_command(self, command):
-        # buffer = bytearray(self.command_address)
-        # buffer += command
-        return command
+    def run_writes(self, deadline):
+        # Drains the write queue inside the bus gap between two packs, a write is only
+        # started while the gap still has room for it and its read back. Writes to packs
+        # that are not healthy wait, a missing reply would cost more than the gap.
+        while len(self.writes) and deadline - monotonic() >= self.write_slot_min:
+            job = self.writes.take(ready=self.write_ready)
+            if job is None:
+                break
+            self.write_batch(*job, deadline=deadline)
 
-    def read_serial_data_eg4_ll(self, command):
-        # use the read_serial_data() function to read the data and then do BMS specific checks (crc, start bytes, etc
+    def write_ready(self, bmsId):
+        health = self.pack_health.get(bmsId)
+        return health is not None and health.state == PACK_HEALTHY
 
-        LENGTH_CHECK = 0
-        LENGTH_CHECK
-        LENGTH_POS = 2  # offset starting from 0
-        LENGTH_FIXED = -1
+    def write_slot_timeout(self, deadline):
+        # Reply timeout for a transaction in the write slot, never below half the minimum slot
+        if deadline is None:
+            return None
+        return max(deadline - monotonic(), self.write_slot_min / 2)
+
+    def write_batch(self, bmsId, start, batch, deadline=None):
+        values = [entry[2] for entry in batch]
+        ok = self.read_serial_data_eg4_ll(
+            build_write_command(bmsId, start, values), reply_timeout=self.write_slot_timeout(deadline)
+        ) is not False
+        if ok:
+            reply = self.read_serial_data_eg4_ll(
+                build_command(bmsId, MODBUS_READ_HOLDING, start, len(values)),
+                probe=True, reply_timeout=self.write_slot_timeout(deadline),
+            )
+            ok = reply is not False and list(unpack_from(f">{len(values)}H", reply, FRAME_HEADER_LENGTH)) == values
+        for offset, entry in enumerate(batch):
+            if not ok and entry[3] + 1 < self.write_attempts:
+                self.writes.retry(bmsId, start + offset, entry)
+            else:
+                for callback in entry[4]:
+                    callback(bmsId, start + offset, ok)
+        if ok:
+            logger.info(f"BMS ID:{bmsId} wrote {len(values)} register(s) from {start:04X}")
+        elif batch[0][3] + 1 >= self.write_attempts:
+            logger.error(f"BMS ID:{bmsId} write of {len(values)} register(s) from {start:04X} failed")
+        return ok
+
+    def generate_command(self, bmsId, name):
+        start, count = self.REGISTERS[name]
+        return build_command(bmsId, MODBUS_READ_HOLDING, start, count)
+
+    def get_reopen_count(self):
+        return self.bus.reopen_count
+
+    def read_serial_data_eg4_ll(self, command, probe=False, reply_timeout=None):
+        # read the reply over the persistent connection and then do BMS specific checks (crc, start bytes, etc
+        # probe: discovery read, short reply timeout and no logging / back off when nothing answers
+        # reply_timeout: overrides the bus (or probe) reply timeout
 
         if self.debug:
             logger.info(f'Executed Command: {command.hex(":").upper()}')
 
-        serial_data = read_serial_data(
-            command, self.port, self.baud_rate, self.LENGTH_POS, self.LENGTH_CHECK
-        )
+        # The count byte only holds up to 255 bytes, larger reads are sized from the request
+        write = command[1] in WRITE_FUNCTIONS
+        data_length = int.from_bytes(command[4:6], "big") * 2
+        if write:
+            data_length = WRITE_REPLY_DATA_LENGTH
+        elif data_length <= 0xFF:
+            data_length = None
+        if reply_timeout is None and probe:
+            reply_timeout = self.discovery_timeout
+        self.last_exception = None
+        started = monotonic()
+        serial_data = self.bus.transact(command, data_length, reply_timeout)
+        finished = monotonic()
+        self.metrics.io_time += finished - started
+        if self.capture is not None:
+            self.capture.write(finished, command[0], command, serial_data or self.bus.last_bad_crc or b"")
+        if not serial_data and self.bus.last_bad_crc:
+            # The reader dropped a garbled reply while looking for a valid one
+            serial_data = self.bus.last_bad_crc
+        if not serial_data:
+            if self.bus.last_partial:
+                self.metrics.record(command, METRIC_SHORT, finished - started)
+            else:
+                self.metrics.record(command, METRIC_TIMEOUT, finished - started)
+        if not serial_data and probe:
+            return False
         if not serial_data: #Test for False / No-Reply
             failedCommandHex = command.hex(":").upper()
             bmsId = int(failedCommandHex[0:2], 16)
             cmdId = failedCommandHex[9:11]
-            if cmdId == "69":
+            if write:
+                # Writes are retried by the write queue, no back off inside the poll cycle
+                logger.error(f"No Reply - BMS ID:{bmsId} Command-Write")
+                return False
+            elif failedCommandHex[15:17] == "12":
+                commandString = "Cell (fast)"
+            elif cmdId == "69":
                 commandString = "Hardware"
             elif cmdId == "00":
                 commandString = "Cell"
@@ -679,6 +2949,20 @@ class EG4_LL(Battery):
 
             return False
 
+        if not crc_valid(serial_data):
+            self.metrics.record(command, METRIC_BAD_CRC, finished - started)
+            if not probe:
+                logger.error(f'Bad CRC - BMS ID:{command[0]} Reply: {serial_data.hex(":").upper()}')
+            return False
+
+        if serial_data[1] & 0x80:
+            self.last_exception = serial_data[2]
+            self.metrics.record(command, METRIC_EXCEPTION, finished - started)
+            logger.error(f"Exception Reply - BMS ID:{serial_data[0]} Code:{serial_data[2]}")
+            return False
+
+        self.metrics.record(command, METRIC_OK, finished - started)
+
         # Its not quite modbus, but psuedo modbus'ish'
         modbus_address, modbus_type, modbus_cmd, modbus_packet_length = unpack_from(
             "BBBB", serial_data
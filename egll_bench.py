@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks for the EG4 LL driver hot path: frame decode, bank rollup, alarm lookups,
+# status logging and full poll cycles against the pty emulator.
+# Run from the dbus-serialbattery bms directory (battery.py / utils.py must be importable):
+#   python egll_bench.py --packs 1,4,8,16 --baud 9600 --latency 0.01 --json bench.json
+# Results are printed and, with --json, written as one JSON document to compare between versions.
+
+from struct import pack
+from time import perf_counter
+from timeit import Timer
+import argparse
+import json
+import logging
+import platform
+import sys
+import tracemalloc
+
+import egll
+from egll import CELL_FRAME, EG4_LL, build_command, decode_cell_frame, decode_fast_frame, crc16_modbus
+from utils import logger
+
+
+def make_cell_frame(bmsId=16, cells=(3312, 3315, 3309, 3318), current=-1250, soc=87):
+    # Synthetic CELL reply with the same layout the BMS sends
+    cellSlots = list(cells) + [0] * (16 - len(cells))
+    data = CELL_FRAME.pack(
+        sum(cells) // 10, current, *cellSlots, 21,
+        310, 200, 100, soc, 0x00, 0x02, 0x0000, 0x0000, 0x0000,
+        42, 400 * 3600 * 1000, 20, 23, len(cells),
+    )
+    data += bytes(0x27 * 2 - len(data))
+    frame = pack(">BBB", bmsId, 0x03, len(data)) + data
+    return frame + pack("<H", crc16_modbus(frame))
+
+
+def legacy_decode_cell(packet):
+    # The slice / int.from_bytes / dict decoder the driver used before PackSnapshot, kept as a baseline
+    battery = {}
+    battery.update({"voltage" : int.from_bytes(packet[3:5], "big") / 100})
+    battery.update({"current" : int.from_bytes(packet[5:7], "big", signed=True) / 100})
+    battery.update({"capacity_remain" : int.from_bytes(packet[45:47], "big")})
+    battery.update({"capacity" : int.from_bytes(packet[65:69], "big") / 3600 / 1000})
+    battery.update({"max_battery_charge_current" : int.from_bytes(packet[47:49], "big")})
+    battery.update({"soc" : int.from_bytes(packet[51:53], "big")})
+    battery.update({"soh" : int.from_bytes(packet[49:51], "big")})
+    battery.update({"cycles" : int.from_bytes(packet[61:65], "big")})
+    battery.update({"temp1" : int.from_bytes(packet[39:41], "big", signed=True)})
+    battery.update({"temp2" : int.from_bytes(packet[69:70], "big", signed=True)})
+    battery.update({"temp_mos" : int.from_bytes(packet[70:71], "big", signed=True)})
+    battery.update({"temp_max" : max(battery["temp1"], battery["temp2"])})
+    battery.update({"temp_min" : min(battery["temp1"], battery["temp2"])})
+    battery.update({"cell_count" : int.from_bytes(packet[75:77], "big")})
+    battery.update({"status_hex" : packet[54:55].hex().upper()})
+    battery.update({"warning_hex" : packet[55:57].hex().upper()})
+    battery.update({"protection_hex" : packet[57:59].hex().upper()})
+    battery.update({"error_hex" : packet[59:61].hex().upper()})
+    battery.update({"heater_status" : packet[53:54].hex().upper()})
+    startByte = 7
+    endByte = 9
+    cellId = 1
+    cellVoltageList = []
+    cellVoltageSum = 0
+    while cellId <= battery["cell_count"]:
+        cellNum = "cell"+str(cellId)
+        cellVolt = int.from_bytes(packet[startByte:endByte], "big")/1000
+        battery.update({cellNum : cellVolt})
+        cellVoltageSum += float(battery[cellNum])
+        cellVoltageList.append(battery.get(cellNum))
+        startByte += 2
+        endByte += 2
+        cellId += 1
+    battery.update({"cell_voltage" : cellVoltageSum})
+    battery.update({"cell_max" : max(cellVoltageList)})
+    battery.update({"cell_min" : min(cellVoltageList)})
+    return battery
+
+
+def time_per_call(func, *args, repeat=5):
+    timer = Timer(lambda: func(*args))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def allocations_per_call(func, *args, calls=1000):
+    # Keep every result alive so the allocations are still counted when the snapshot is taken
+    results = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(calls):
+        results.append(func(*args))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    blocks = sum(stat.count_diff for stat in stats) - 1  # the results list itself
+    size = sum(stat.size_diff for stat in stats)
+    return blocks / calls, size / calls
+
+
+def make_fast_frame(bmsId=16, cells=(3312, 3315, 3309, 3318), current=-1250):
+    frame = make_cell_frame(bmsId, cells, current)
+    data = frame[3:3 + 0x12 * 2]
+    frame = pack(">BBB", bmsId, 0x03, len(data)) + data
+    return frame + pack("<H", crc16_modbus(frame))
+
+
+def pack_ids(packs):
+    # Master 16 plus slaves 1 .. packs - 1
+    return [16] + list(range(1, packs))
+
+
+def make_bank(packs, variant=0):
+    # Snapshots for a chain, variant shifts the values so every variant has new fingerprints
+    stats = {}
+    for bmsId in pack_ids(packs):
+        base = 3300 + (bmsId + variant) % 7
+        stats[bmsId] = decode_cell_frame(
+            make_cell_frame(bmsId, (base, base + 3, base - 2, base + 5), -1250 + variant, 60 + bmsId % 30)
+        ).update_hw({"hw_make" : "LL-12V400AH", "hw_version" : "V1.3.0", "hw_serial" : f"BENCH_{bmsId}"})
+    return stats
+
+
+def make_battery(packs):
+    battery = EG4_LL("bench", 9600, 0)
+    battery.history = None
+    battery.batteryPackId = pack_ids(packs)
+    return battery
+
+
+def bench_decode():
+    frame = make_cell_frame()
+    results = {}
+    for name, func in (("legacy_dict", legacy_decode_cell), ("pack_snapshot", decode_cell_frame)):
+        blocks, size = allocations_per_call(func, frame)
+        results[name] = {
+            "decode_us" : time_per_call(func, frame) * 1e6,
+            "alloc_blocks" : blocks,
+            "alloc_bytes" : size,
+        }
+    previous = decode_cell_frame(frame)
+    fast = make_fast_frame()
+    blocks, size = allocations_per_call(decode_fast_frame, fast, previous)
+    results["fast_frame"] = {
+        "decode_us" : time_per_call(decode_fast_frame, fast, previous) * 1e6,
+        "alloc_blocks" : blocks,
+        "alloc_bytes" : size,
+    }
+    return results
+
+
+def bench_rollup(packs):
+    # Rollup with every pack changed (two alternating banks) and with nothing changed
+    battery = make_battery(packs)
+    banks = [make_bank(packs, 0), make_bank(packs, 1)]
+    flip = [0]
+
+    def changed():
+        flip[0] ^= 1
+        battery.battery_stats = banks[flip[0]]
+        battery.rollupBatteryBank(battery.battery_stats)
+
+    def unchanged():
+        battery.rollupBatteryBank(battery.battery_stats)
+
+    changed()
+    result = {
+        "rollup_changed_us" : time_per_call(changed) * 1e6,
+        "rollup_unchanged_us" : time_per_call(unchanged) * 1e6,
+        "alarm_lookup_us" : time_per_call(lambda: (
+            battery.lookup_warning(battery.battery_stats),
+            battery.lookup_protection(battery.battery_stats),
+            battery.lookup_error(battery.battery_stats),
+        )) * 1e6,
+        "balancing_us" : time_per_call(battery.get_balancing) * 1e6,
+    }
+
+    # status_logger formats every line even when the logger drops them, time it with logging silenced
+    level = logger.level
+    logger.setLevel(logging.CRITICAL)
+    try:
+        result["status_logger_us"] = time_per_call(battery.status_logger, battery.battery_stats, repeat=3) * 1e6
+    finally:
+        logger.setLevel(level)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(100):
+        changed()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    result["cycle_alloc_blocks"] = sum(stat.count_diff for stat in stats) / 100
+    result["cycle_alloc_bytes"] = sum(stat.size_diff for stat in stats) / 100
+    return result
+
+
+def bench_poll(packs, baud, latency, cycles):
+    # Full refresh_data cycles against the emulated chain, including the driver's own bus pacing
+    from egll_emulator import EG4LLEmulator
+
+    emulator = EG4LLEmulator(pack_ids(packs), baud=baud, latency=latency)
+    port = emulator.start()
+    battery = EG4_LL(port, baud, 0)
+    battery.history = None
+    battery.state_file = None  # Always measure a cold start
+    battery.batteryPackId = pack_ids(packs)
+    level = logger.level
+    logger.setLevel(logging.WARNING)
+    try:
+        started = perf_counter()
+        connected = battery.test_connection() and battery.get_settings()
+        startup = perf_counter() - started
+        times = []
+        written, read = battery.bus.bytes_written, battery.bus.bytes_read
+        for _ in range(cycles):
+            started = perf_counter()
+            battery.refresh_data()
+            times.append(perf_counter() - started)
+        return {
+            "connected" : bool(connected),
+            "startup_s" : startup,
+            "cycle_mean_s" : sum(times) / len(times),
+            "cycle_max_s" : max(times),
+            "bytes_per_cycle" : (battery.bus.bytes_written - written + battery.bus.bytes_read - read) / cycles,
+        }
+    finally:
+        logger.setLevel(level)
+        battery.bus.close()
+        emulator.stop()
+
+
+def run(packs, baud, latency, cycles, poll):
+    results = {
+        "python" : platform.python_version(),
+        "machine" : platform.machine(),
+        "numpy" : egll.np is not None,
+        "decode" : bench_decode(),
+        "rollup" : {},
+        "poll" : {},
+    }
+    for count in packs:
+        results["rollup"][str(count)] = bench_rollup(count)
+    if poll:
+        results["poll_settings"] = {"baud" : baud, "latency_s" : latency, "cycles" : cycles}
+        for count in packs:
+            results["poll"][str(count)] = bench_poll(count, baud, latency, cycles)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EG4 LL driver benchmarks")
+    parser.add_argument("--packs", default="1,4,8,16", help="comma separated chain sizes")
+    parser.add_argument("--baud", type=int, default=9600, help="emulated wire speed for the poll benchmark")
+    parser.add_argument("--latency", type=float, default=0.0, help="emulated BMS turnaround in seconds")
+    parser.add_argument("--cycles", type=int, default=5, help="poll cycles per chain size")
+    parser.add_argument("--no-poll", action="store_true", help="skip the emulated poll cycle benchmark")
+    parser.add_argument("--json", help="write the results to this file, - for stdout")
+    args = parser.parse_args()
+
+    packs = [int(count) for count in args.packs.split(",") if count]
+    results = run(packs, args.baud, args.latency, args.cycles, not args.no_poll)
+
+    print(f"CELL command: {build_command(16, 0x03, 0x0000, 0x27).hex(':').upper()}")
+    for name, result in results["decode"].items():
+        print(
+            f"{name:>14}: {result['decode_us']:.2f} us/frame | "
+            f"{result['alloc_blocks']:.1f} blocks, {result['alloc_bytes']:.0f} bytes retained/frame"
+        )
+    for count, result in results["rollup"].items():
+        print(
+            f"{count:>2} packs rollup: {result['rollup_changed_us']:.1f} us changed / "
+            f"{result['rollup_unchanged_us']:.1f} us unchanged | alarms {result['alarm_lookup_us']:.1f} us | "
+            f"status_logger {result['status_logger_us']:.0f} us | {result['cycle_alloc_bytes']:.0f} bytes/cycle"
+        )
+    for count, result in results["poll"].items():
+        print(
+            f"{count:>2} packs poll: startup {result['startup_s']:.2f}s | cycle {result['cycle_mean_s'] * 1000:.0f} ms "
+            f"mean / {result['cycle_max_s'] * 1000:.0f} ms max | {result['bytes_per_cycle']:.0f} bytes/cycle"
+        )
+
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=2)
+    elif args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+# EG4 LL BMS chain emulator on a pseudo-terminal, for testing the driver without batteries.
+# Run from the dbus-serialbattery bms directory (battery.py / utils.py must be importable):
+#   python egll_emulator.py --packs 16 --link /tmp/ttyEG4
+# then point the driver port at /tmp/ttyEG4 (or at the printed /dev/pts/N).
+#
+# Every pack answers Modbus reads (function 0x03) of any range inside its register image,
+# so HW, CELL, CONFIG, FAST and wide reads all work, and accepts register writes (0x06 / 0x10). Faults can be injected per request:
+# no reply, truncated frame, bad CRC and slow responders.
+
+from struct import pack
+from time import monotonic, sleep
+import argparse
+import os
+import random
+import select
+import threading
+import tty
+
+from egll import (
+    CELL_FRAME, CELL_SLOTS, CONFIG_FIELDS, MODBUS_WRITE_MULTIPLE, MODBUS_WRITE_SINGLE, REGISTERS,
+    crc16_modbus,
+)
+
+REGISTER_COUNT = max(start + count for start, count in REGISTERS.values())
+HW_START = REGISTERS["HW"][0]
+CONFIG_START = REGISTERS["CONFIG"][0]
+# Factory settings of a 4S LL pack, in the units CONFIG_FIELDS decodes to
+DEFAULT_CONFIG = {
+    "cell_over_voltage_alarm" : 3.60, "cell_over_voltage_protect" : 3.65, "cell_over_voltage_release" : 3.40,
+    "cell_under_voltage_alarm" : 2.90, "cell_under_voltage_protect" : 2.80, "cell_under_voltage_release" : 3.00,
+    "pack_over_voltage_alarm" : 14.40, "pack_over_voltage_protect" : 14.60, "pack_over_voltage_release" : 13.60,
+    "pack_under_voltage_alarm" : 11.60, "pack_under_voltage_protect" : 11.20, "pack_under_voltage_release" : 12.00,
+    "charge_over_current_alarm" : 200, "charge_over_current_protect" : 210,
+    "discharge_over_current_alarm" : 200, "discharge_over_current_protect" : 210,
+    "charge_over_temp_alarm" : 50, "charge_over_temp_protect" : 55,
+    "charge_under_temp_alarm" : 2, "charge_under_temp_protect" : 0,
+    "discharge_over_temp_alarm" : 55, "discharge_over_temp_protect" : 60,
+    "discharge_under_temp_alarm" : -15, "discharge_under_temp_protect" : -20,
+    "mos_over_temp_alarm" : 80, "mos_over_temp_protect" : 90,
+    "balancer_voltage" : 3.40, "balancer_delta" : 0.03,
+}
+
+
+class EmulatedPack:
+    # One BMS: a register image regenerated from a small electrical model on every tick
+
+    def __init__(self, bmsId, cells=4, capacity=400, rng=None):
+        self.bmsId = bmsId
+        self.cells = cells
+        self.capacity = capacity
+        self.rng = rng or random.Random(bmsId)
+        self.soc = self.rng.uniform(40, 90)
+        self.current = 0.0
+        self.temp = self.rng.uniform(18, 25)
+        self.cycles = self.rng.randint(5, 300)
+        self.cell_offsets = [self.rng.gauss(0, 0.004) for _ in range(cells)]
+        self.forced_warning = 0
+        self.forced_protection = 0
+        self.registers = [0] * REGISTER_COUNT
+        self.write_hw()
+        self.write_config(DEFAULT_CONFIG)
+        self.tick(0)
+
+    def write_hw(self):
+        # Same offsets read_hw_details slices: make, version, serial
+        data = bytearray(REGISTERS["HW"][1] * 2)
+        make = b"LL-12V400AH-EG4-LFP"
+        data[0:len(make)] = make
+        data[24:30] = b"V1.3.0"
+        data[30:45] = f"EG4LL{self.bmsId:02d}{self.rng.randint(0, 99999999):08d}".encode()[:15]
+        for idx in range(0, len(data), 2):
+            self.registers[HW_START + idx // 2] = (data[idx] << 8) | data[idx + 1]
+
+    def write_config(self, values):
+        # Encoded with the same table the driver decodes, settings not in values keep their register
+        for name, offset, scale, signed in CONFIG_FIELDS:
+            if name in values:
+                self.registers[CONFIG_START + offset] = round(values[name] * scale) & 0xFFFF
+
+    def cell_voltage(self, idx):
+        # Flat LFP curve with knees at both ends, sag / rise with current
+        soc = self.soc / 100
+        ocv = 3.0 + 0.3 * soc + 0.35 * max(0.0, soc - 0.95) * 20 - 0.4 * max(0.0, 0.05 - soc) * 20
+        return ocv + self.cell_offsets[idx] + self.current * 0.0004 + self.rng.gauss(0, 0.001)
+
+    def tick(self, elapsed):
+        self.current = max(-150.0, min(150.0, self.current + self.rng.gauss(0, 5)))
+        self.soc = max(0.0, min(100.0, self.soc + self.current * elapsed / 3600 / self.capacity * 100))
+        self.temp += self.rng.gauss(0, 0.05) + abs(self.current) * 0.00005 * elapsed
+        cells = [round(self.cell_voltage(idx) * 1000) for idx in range(self.cells)]
+
+        warning = self.forced_warning
+        protection = self.forced_protection
+        if max(cells) > 3600:
+            warning |= 0x0002
+        if max(cells) > 3650:
+            protection |= 0x0002
+        if min(cells) < 2900:
+            warning |= 0x0008
+        if min(cells) < 2800:
+            protection |= 0x0008
+        if self.soc < 10:
+            warning |= 0x1000
+        status = 0x01 if self.current > 1 else 0x02 if self.current < -1 else 0x00
+
+        temp = round(self.temp)
+        data = CELL_FRAME.pack(
+            round(sum(cells) / 10), round(self.current * 100),
+            *(cells + [0] * (CELL_SLOTS - self.cells)), temp,
+            round(self.soc / 100 * self.capacity), 200, 100, round(self.soc), 0x00, status,
+            warning, protection, 0, self.cycles, self.capacity * 3600 * 1000, temp - 1, temp + 2, self.cells,
+        )
+        data += bytes(REGISTERS["CELL"][1] * 2 - len(data))
+        for idx in range(0, len(data), 2):
+            self.registers[idx // 2] = (data[idx] << 8) | data[idx + 1]
+
+    def write(self, start, values):
+        # Written registers stick, except the live CELL block which the model renders again on every tick
+        if start + len(values) > REGISTER_COUNT:
+            return False
+        for offset, value in enumerate(values):
+            self.registers[start + offset] = value
+        return True
+
+    def read(self, start, count):
+        if start + count > REGISTER_COUNT:
+            return None
+        return b"".join(pack(">H", value) for value in self.registers[start:start + count])
+
+
+class EG4LLEmulator:
+    # Answers requests on the master side of a pty pair from a background thread
+
+    def __init__(self, ids=(16, 1), cells=4, baud=9600, seed=1, no_reply=0.0, truncate=0.0, bad_crc=0.0,
+                 slow=0.0, slow_ids=(), dead_ids=(), link=None, latency=0.0):
+        self.rng = random.Random(seed)
+        self.packs = {bmsId : EmulatedPack(bmsId, cells, rng=random.Random(seed * 100 + bmsId)) for bmsId in ids}
+        self.baud = baud
+        self.no_reply = no_reply
+        self.truncate = truncate
+        self.bad_crc = bad_crc
+        self.slow = slow
+        self.slow_ids = set(slow_ids)
+        self.dead_ids = set(dead_ids)
+        self.link = link
+        self.latency = latency
+        self.requests = 0
+        self.faults = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        if link:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.port, link)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="EG4 LL emulator", daemon=True)
+        self.thread.start()
+        return self.link or self.port
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.link and os.path.islink(self.link):
+            os.remove(self.link)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def wire_time(self, length):
+        # 10 bits per byte on the wire
+        return length * 10 / self.baud if self.baud else 0
+
+    def run(self):
+        buffer = bytearray()
+        last_tick = monotonic()
+        while not self.stop_event.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            now = monotonic()
+            if now - last_tick >= 1.0:
+                for emulated in self.packs.values():
+                    emulated.tick(now - last_tick)
+                last_tick = now
+            if not ready:
+                continue
+            buffer += os.read(self.master, 256)
+            while len(buffer) >= 8:
+                length = 8
+                if buffer[1] == MODBUS_WRITE_MULTIPLE:
+                    length = 9 + buffer[6]
+                    if len(buffer) < length:
+                        break
+                request = bytes(buffer[:length])
+                if crc16_modbus(request[:-2]) != (request[-2] | (request[-1] << 8)):
+                    del buffer[0]  # Not a request, resync
+                    continue
+                del buffer[:length]
+                self.answer(request)
+
+    def answer(self, request):
+        self.requests += 1
+        bmsId, function = request[0], request[1]
+        start = (request[2] << 8) | request[3]
+        count = (request[4] << 8) | request[5]
+        emulated = self.packs.get(bmsId)
+        if emulated is None or bmsId in self.dead_ids:
+            return
+        if self.rng.random() < self.no_reply:
+            self.faults += 1
+            return
+
+        if function in (MODBUS_WRITE_SINGLE, MODBUS_WRITE_MULTIPLE):
+            # The reply echoes address, function, register and value / count
+            if function == MODBUS_WRITE_SINGLE:
+                values = [count]
+            else:
+                values = [(request[7 + idx * 2] << 8) | request[8 + idx * 2] for idx in range(count)]
+            frame = request[:6] if emulated.write(start, values) else bytes((bmsId, function | 0x80, 0x02))
+        else:
+            data = emulated.read(start, count) if function == 0x03 else None
+            if data is None:
+                frame = bytes((bmsId, function | 0x80, 0x02))
+            else:
+                # Replies longer than 255 bytes wrap the count byte, like the wide read
+                frame = bytes((bmsId, function, len(data) & 0xFF)) + data
+        frame += pack("<H", crc16_modbus(frame))
+
+        if self.rng.random() < self.bad_crc:
+            self.faults += 1
+            frame = frame[:-1] + bytes((frame[-1] ^ 0xFF,))
+        if self.rng.random() < self.truncate:
+            self.faults += 1
+            frame = frame[:self.rng.randint(1, len(frame) - 1)]
+        if bmsId in self.slow_ids:
+            sleep(self.slow)
+        sleep(self.latency + self.wire_time(len(request)) + self.wire_time(len(frame)))
+        os.write(self.master, frame)
+
+
+def parse_ids(text):
+    return [int(value) for value in text.split(",") if value]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate a chain of EG4 LL BMS units on a pseudo-terminal")
+    parser.add_argument("--packs", type=int, default=2, help="number of packs: ID 16 plus 1 .. packs - 1")
+    parser.add_argument("--ids", type=parse_ids, help="explicit comma separated BMS IDs, overrides --packs")
+    parser.add_argument("--cells", type=int, default=4)
+    parser.add_argument("--baud", type=int, default=9600, help="emulated wire speed, 0 answers instantly")
+    parser.add_argument("--latency", type=float, default=0.0, help="BMS turnaround in seconds before every reply")
+    parser.add_argument("--link", help="symlink to create for the pty, e.g. /tmp/ttyEG4")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-reply", type=float, default=0.0, help="probability a request is ignored")
+    parser.add_argument("--truncate", type=float, default=0.0, help="probability a reply is cut short")
+    parser.add_argument("--bad-crc", type=float, default=0.0, help="probability a reply has a broken CRC")
+    parser.add_argument("--slow", type=float, default=0.0, help="extra seconds before the slow IDs answer")
+    parser.add_argument("--slow-ids", type=parse_ids, default=[])
+    parser.add_argument("--dead-ids", type=parse_ids, default=[], help="IDs that never answer")
+    parser.add_argument("--warning", type=lambda value: int(value, 0), default=0, help="warning bits forced on every pack")
+    parser.add_argument("--protection", type=lambda value: int(value, 0), default=0, help="protection bits forced on every pack")
+    args = parser.parse_args()
+
+    ids = args.ids or [16] + list(range(1, args.packs))
+    emulator = EG4LLEmulator(
+        ids, args.cells, args.baud, args.seed, args.no_reply, args.truncate, args.bad_crc,
+        args.slow, args.slow_ids, args.dead_ids, args.link, args.latency,
+    )
+    for emulated in emulator.packs.values():
+        emulated.forced_warning = args.warning
+        emulated.forced_protection = args.protection
+    port = emulator.start()
+    print(f"Emulating BMS IDs {ids} on {port} ({emulator.port}), Ctrl-C to stop")
+    try:
+        while True:
+            sleep(10)
+            print(f"{emulator.requests} requests, {emulator.faults} injected faults")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# Bus multiplexer for an EG4 LL chain: owns the serial port and lets several local
+# consumers (the dbus driver, a logger, diagnostics) share it over a Unix socket.
+# Run from the dbus-serialbattery bms directory (battery.py / utils.py must be importable):
+#   python egll_mux.py /dev/ttyUSB0 --socket /run/eg4_ll.sock --ttl 0.5
+# then set EG4_LL.mux_socket = "/run/eg4_ll.sock" in every consumer.
+#
+# Requests from all clients are serialised onto the bus one at a time. Valid read
+# replies are cached for --ttl seconds, so the same CELL read from several consumers
+# within the TTL costs one bus transaction. Anything that is not a read goes straight
+# to the bus and drops the cached replies of that BMS.
+
+from time import monotonic, sleep
+import argparse
+import logging
+import os
+import socketserver
+import threading
+
+from egll import (
+    EG4_LL_Serial, MODBUS_READ_HOLDING, MUX_REPLY, MUX_REQUEST, command_name, crc_valid, recv_exact,
+)
+from utils import logger
+
+
+class BusMultiplexer:
+    # The shared serial bus plus the reply cache. The lock is held for the whole
+    # transaction, a request that waited for it checks the cache again first so
+    # identical reads queued behind each other are answered by the first one.
+
+    def __init__(self, port, baud, ttl=0.5, gap=0.01):
+        self.bus = EG4_LL_Serial(port, baud)
+        self.ttl = ttl
+        self.gap = gap  # Bus silence between two transactions
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.last_transaction = 0.0
+        self.requests = 0
+        self.hits = 0
+        self.transactions = 0
+        self.debug = False
+
+    def cached(self, command):
+        entry = self.cache.get(command)
+        if entry is not None and monotonic() - entry[0] <= self.ttl:
+            self.hits += 1
+            return entry[1]
+        return None
+
+    def request(self, command, data_length=None, reply_timeout=None):
+        # Returns (reply frame or False, bytes received before a timeout)
+        self.requests += 1
+        cacheable = command[1] == MODBUS_READ_HOLDING
+        if cacheable:
+            reply = self.cached(command)
+            if reply is not None:
+                return reply, 0
+        with self.lock:
+            if cacheable:
+                reply = self.cached(command)
+                if reply is not None:
+                    return reply, 0
+            wait = self.gap - (monotonic() - self.last_transaction)
+            if wait > 0:
+                sleep(wait)
+            reply = self.bus.transact(command, data_length, reply_timeout)
+            self.last_transaction = monotonic()
+            self.transactions += 1
+            if not reply:
+                # A garbled reply goes to the client as is, so it is counted as a bad CRC there
+                if self.bus.last_bad_crc:
+                    return self.bus.last_bad_crc, 0
+                return False, self.bus.last_partial
+            if cacheable and crc_valid(reply) and not reply[1] & 0x80:
+                self.cache[command] = (self.last_transaction, reply)
+            elif not cacheable:
+                for cachedCommand in [cachedCommand for cachedCommand in self.cache if cachedCommand[0] == command[0]]:
+                    del self.cache[cachedCommand]
+            return reply, 0
+
+    def summary(self):
+        return (
+            f"Mux: {self.requests} requests, {self.hits} cache hits, {self.transactions} bus transactions, "
+            f"{self.bus.reopen_count} reopens"
+        )
+
+
+class MuxHandler(socketserver.BaseRequestHandler):
+    # One connected client, requests are answered in order until it disconnects
+
+    def handle(self):
+        mux = self.server.mux
+        while True:
+            try:
+                length, data_length, reply_timeout = MUX_REQUEST.unpack(recv_exact(self.request, MUX_REQUEST.size))
+                command = recv_exact(self.request, length)
+            except OSError:
+                return
+            reply, partial = mux.request(command, data_length or None, reply_timeout or None)
+            if mux.debug:
+                logger.debug(f"{command_name(command)} BMS ID:{command[0]} -> {len(reply) if reply else 'no reply'}")
+            try:
+                self.request.sendall(MUX_REPLY.pack(len(reply) if reply else 0, partial) + (reply or b""))
+            except OSError:
+                return
+
+
+class MuxServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share one EG4 LL RS485 chain between several local processes")
+    parser.add_argument("port", help="serial port of the chain, e.g. /dev/ttyUSB0")
+    parser.add_argument("--baud", type=int, default=9600)
+    parser.add_argument("--socket", default="/run/eg4_ll.sock", help="Unix socket the clients connect to")
+    parser.add_argument("--ttl", type=float, default=0.5, help="seconds a read reply is served from the cache")
+    parser.add_argument("--gap", type=float, default=0.01, help="minimum bus silence between transactions in seconds")
+    parser.add_argument("--stats", type=float, default=60, help="seconds between summary log lines, 0 disables them")
+    parser.add_argument("--debug", action="store_true", help="log every request")
+    args = parser.parse_args()
+
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    mux = BusMultiplexer(args.port, args.baud, args.ttl, args.gap)
+    mux.debug = args.debug
+    if not mux.bus.open():
+        raise SystemExit(1)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = MuxServer(args.socket, MuxHandler)
+    server.mux = mux
+    thread = threading.Thread(target=server.serve_forever, name="EG4 LL mux", daemon=True)
+    thread.start()
+    logger.info(f"Multiplexing {args.port} on {args.socket}")
+    try:
+        while True:
+            sleep(args.stats or 3600)
+            if args.stats:
+                logger.info(mux.summary())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(args.socket)
+        mux.bus.close()
+
+
+if __name__ == "__main__":
+    main()
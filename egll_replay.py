@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+# Offline replay of an EG4 LL capture file (EG4_LL.capture_file) through the driver decoders and bank rollup.
+# Run from the dbus-serialbattery bms directory (battery.py / utils.py must be importable):
+#   python egll_replay.py capture.bin [--every N]
+
+from time import perf_counter
+import argparse
+
+from egll import EG4_LL
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an EG4 LL capture file without a serial port")
+    parser.add_argument("capture", help="capture file written by the driver")
+    parser.add_argument("--every", type=int, default=0, help="print the bank every N sweeps, 0 only prints the last one")
+    args = parser.parse_args()
+
+    battery = EG4_LL("replay", 9600, 0)
+    battery.history = None
+    sweeps = [0]
+
+    def show(timestamp, bank):
+        sweeps[0] += 1
+        if timestamp is None or (args.every and sweeps[0] % args.every == 0):
+            print(
+                f"t={timestamp if timestamp is not None else 'end'} packs={len(bank.battery_stats)} "
+                f"V={bank.voltage:.3f} I={bank.current} SoC={bank.soc:.1f} "
+                f"cell min/max={bank.cell_min_voltage}/{bank.cell_max_voltage} "
+                f"warning={bank.alarm_warning:04X} protection={bank.alarm_protection:04X}"
+            )
+
+    started = perf_counter()
+    decoded = battery.replay_capture(args.capture, show)
+    elapsed = perf_counter() - started
+    print(f"{decoded} frames, {sweeps[0]} sweeps in {elapsed:.3f}s ({decoded / elapsed if elapsed else 0:.0f} frames/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+# The driver is a dbus-serialbattery module and imports its battery / utils modules.
+# Put that bms directory on the path to test against the real ones:
+#   PYTHONPATH=/path/to/dbus-serialbattery/bms python -m pytest -q tests
+# Without it, minimal stand-ins are installed instead. They only carry what egll.py
+# uses from them, enough for the protocol code and the EG4_LL logic under test.
+
+import logging
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import battery  # noqa: F401
+    import utils  # noqa: F401
+except ImportError:
+    class Cell:
+        def __init__(self, balance):
+            self.balance = balance
+            self.voltage = None
+
+    class Battery:
+        def __init__(self, port, baud, address):
+            self.port = port
+            self.baud_rate = baud
+            self.address = address
+            self.cells = []
+            self.voltage = None
+            self.current = None
+            self.soc = None
+            self.charge_mode = None
+            self.control_voltage = None
+            self.control_charge_current = None
+            self.control_discharge_current = None
+            self.charge_limitation = None
+            self.discharge_limitation = None
+
+    battery = types.ModuleType("battery")
+    battery.Battery = Battery
+    battery.Cell = Cell
+    utils = types.ModuleType("utils")
+    utils.logger = logging.getLogger("SerialBattery")
+    utils.MIN_CELL_VOLTAGE = 2.9
+    utils.MAX_CELL_VOLTAGE = 3.45
+    sys.modules["battery"] = battery
+    sys.modules["utils"] = utils
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import pytest
+
+from egll import (
+    CELL_FRAME, CONFIG_FIELDS, CONFIG_FRAME, EG4_LL, EG4_LL_Serial, FAST_FRAME, FRAME_HEADER_LENGTH,
+    MODBUS_READ_HOLDING, PACK_HEALTHY, PACK_QUARANTINED, PACK_SUSPECT, PROTECTION_BITS, REGISTERS, WARNING_BITS,
+    HistoryRing, PackHealth, PollScheduler, WriteQueue, alarm_text, build_command, build_commands,
+    build_write_command, crc16_modbus, crc_valid, decode_cell_frame, decode_config_frame, decode_fast_frame,
+    register_span, split_frame,
+)
+from egll_emulator import EG4LLEmulator
+
+
+@pytest.mark.parametrize("sign", [1, -1])
+def test_history_window_after_wrap(sign):
+    # Strictly monotonic values keep every sample in one of the queues, which must
+    # not overwrite its own head once the ring wraps
+    history = HistoryRing(["v"], 5, (100, 3))
+    for second in range(12):
+        history.append(float(second), [sign * second])
+        kept = [sign * value for value in range(max(0, second - 4), second + 1)]
+        window = history.window("v", 100, now=float(second))
+        assert (window["min"], window["max"]) == (min(kept), max(kept))
+        recent = [value for value in kept if abs(value) >= second - 3]
+        window = history.window("v", 3, now=float(second))
+        assert (window["min"], window["max"]) == (min(recent), max(recent))
+
+
+def cell_packet(cells, soc=80, warning=0, protection=0):
+    fields = [5330, 120] + cells + [25, 100, 100, 100, soc, 0, 1, warning, protection, 0, 5, 360000000, 24, 26, 16]
+    return bytes(FRAME_HEADER_LENGTH) + CELL_FRAME.pack(*fields)
+
+
+def fast_packet(cells):
+    return bytes(FRAME_HEADER_LENGTH) + FAST_FRAME.pack(5330, 120, *cells)
+
+
+def test_fast_fingerprint_depends_on_values_only():
+    cells = [3330] * 16
+    previous = decode_cell_frame(cell_packet(cells))
+    first = decode_fast_frame(fast_packet(cells), previous)
+    assert first.fingerprint == previous.fingerprint
+    assert decode_fast_frame(fast_packet(cells), first).fingerprint == previous.fingerprint
+    assert decode_fast_frame(fast_packet([3331] + cells[1:]), first).fingerprint != previous.fingerprint
+    assert decode_cell_frame(cell_packet(cells, soc=81)).fingerprint != previous.fingerprint
+
+
+def test_write_queue_keeps_superseded_callbacks():
+    results = []
+    queue = WriteQueue()
+    queue.put(1, 0x10, [1], callback=lambda *result: results.append(("first",) + result))
+    queue.put(1, 0x10, [2], callback=lambda *result: results.append(("second",) + result))
+    bmsId, start, batch = queue.take()
+    assert (bmsId, start, [entry[2] for entry in batch]) == (1, 0x10, [2])
+    for callback in batch[0][4]:
+        callback(bmsId, start, True)
+    assert results == [("first", 1, 0x10, True), ("second", 1, 0x10, True)]
+
+
+def test_write_queue_priority_is_per_register():
+    queue = WriteQueue()
+    queue.put(1, 0x10, [1], priority=0)
+    queue.put(1, 0x10, [2, 3, 4], priority=5)
+    assert [queue.pending[(1, register)][0] for register in (0x10, 0x11, 0x12)] == [0, 5, 5]
+
+
+def config_packet(**values):
+    registers = [0] * REGISTERS["CONFIG"][1]
+    registers[0x01] = 3650
+    registers[0x04] = 2500
+    for name, offset, scale, signed in CONFIG_FIELDS:
+        if name in values:
+            registers[offset] = values[name]
+    return bytes(FRAME_HEADER_LENGTH) + CONFIG_FRAME.pack(*registers)
+
+
+def test_balancing_stays_on_default_thresholds():
+    # A CONFIG block that would move the balancer start to 3.30 V is ignored by default
+    config = decode_config_frame(config_packet(balancer_voltage=3300, balancer_delta=20))
+    assert config.valid
+    battery = EG4_LL.__new__(EG4_LL)
+    assert battery.status_balancing(3.35, 3.30, config) == (0, "Off")
+    assert battery.status_balancing(3.45, 3.00, config) == (1, "Balancing")
+    battery.config_balancer_thresholds = True
+    assert battery.status_balancing(3.35, 3.30, config) == (1, "Balancing")
+
+class StreamSerial:
+    # Stands in for the serial port, read() hands out a fixed byte stream
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+
+    def read(self, size):
+        chunk = bytes(self.data[:size])
+        del self.data[:size]
+        return chunk
+
+
+def test_read_frame_skips_candidate_with_bad_crc():
+    reply = bytes([0x10, MODBUS_READ_HOLDING, 4, 1, 2, 3, 4])
+    reply += crc16_modbus(reply).to_bytes(2, "little")
+    garbled = reply[:-2] + b"\x00\x00"
+    bus = EG4_LL_Serial("/dev/null", 9600)
+    bus.ser = StreamSerial(garbled + reply)
+    assert bus.read_frame(0x10, MODBUS_READ_HOLDING, reply_timeout=0.1) == reply
+    assert bus.dropped_bytes == len(garbled)
+    bus.ser = StreamSerial(garbled)
+    assert bus.read_frame(0x10, MODBUS_READ_HOLDING, reply_timeout=0.05) is False
+    assert bus.last_bad_crc == garbled
+
+
+
+# Request frames of the hand-written command table the driver carried before build_commands
+LEGACY_COMMANDS = {
+    16 : {"HW" : "100300690017D699", "CELL" : "1003000000270691"},
+    1 : {"HW" : "010300690017D5D8", "CELL" : "01030000002705D0", "CONFIG" : "0103002D005B9438"},
+    2 : {"HW" : "020300690017D5EB", "CELL" : "02030000002705E3"},
+    3 : {"HW" : "030300690017D43A", "CELL" : "0303000000270432"},
+    4 : {"HW" : "040300690017D58D", "CELL" : "0403000000270585"},
+    5 : {"HW" : "050300690017D45C", "CELL" : "0503000000270454"},
+    6 : {"HW" : "060300690017D46F", "CELL" : "0603000000270467"},
+    7 : {"HW" : "070300690017D5BE", "CELL" : "07030000002705B6"},
+    8 : {"HW" : "080300690017D541", "CELL" : "0803000000270549"},
+    9 : {"HW" : "090300690017D490", "CELL" : "0903000000270498"},
+    10 : {"HW" : "0A0300690017D4A3", "CELL" : "0A030000002704AB"},
+    11 : {"HW" : "0B0300690017D572", "CELL" : "0B0300000027057A"},
+    12 : {"HW" : "0C0300690017D4C5", "CELL" : "0C030000002704CD"},
+    13 : {"HW" : "0D0300690017D514", "CELL" : "0D0300000027051C"},
+    14 : {"HW" : "0E0300690017D527", "CELL" : "0E0300000027052F"},
+    15 : {"HW" : "0F0300690017D4F6", "CELL" : "0F030000002704FE"},
+}
+
+
+def test_build_commands_match_legacy_frames():
+    commands = build_commands(list(LEGACY_COMMANDS))
+    for bmsId, frames in LEGACY_COMMANDS.items():
+        for name, frame in frames.items():
+            assert commands[bmsId][name] == bytes.fromhex(frame)
+
+
+def test_crc16_modbus():
+    # Check value of CRC-16/MODBUS, and the classic "write register 1 = 3" request
+    assert crc16_modbus(b"123456789") == 0x4B37
+    assert build_write_command(1, 0x0001, [3]) == bytes.fromhex("010600010003980B")
+    assert crc_valid(build_command(1, MODBUS_READ_HOLDING, 0x0069, 0x17))
+    assert not crc_valid(bytes.fromhex("010300690017D5D9"))
+    assert not crc_valid(b"\x01\x03")
+
+
+def test_write_multiple_command_layout():
+    command = build_write_command(2, 0x0047, [3390, 20])
+    assert command[:7] == bytes.fromhex("02100047000204")
+    assert command[7:11] == bytes.fromhex("0D3E0014")
+    assert crc_valid(command)
+
+
+def test_wide_read_splits_into_blocks():
+    start, count = register_span(("HW", "CELL"))
+    assert (start, count) == (0x0000, 0x69 + 0x17)
+    data = bytes(range(256)) * 2
+    frame = bytes((16, MODBUS_READ_HOLDING, 0)) + data[:count * 2]
+    hw = split_frame(frame, start, "HW")
+    assert hw[:3] == bytes((16, MODBUS_READ_HOLDING, 0x17 * 2))
+    assert hw[3:] == data[0x69 * 2:(0x69 + 0x17) * 2]
+    assert split_frame(frame, start, "CELL")[3:] == data[:0x27 * 2]
+
+
+def test_alarm_masks_from_cell_frame():
+    snapshot = decode_cell_frame(cell_packet([3330] * 16, warning=0x0001 | 0x0400, protection=0x0002))
+    assert (snapshot.warning_hex, snapshot.protection_hex) == (0x0401, 0x0002)
+    battery = EG4_LL.__new__(EG4_LL)
+    battery.set_alarms(snapshot.warning_hex, snapshot.protection_hex, 0)
+    assert battery.voltage_high == 1
+    assert battery.temp_low_charge == 1
+    assert battery.voltage_cell_high == 2
+    assert battery.voltage_low == 0
+
+
+def test_alarm_text_lists_every_bit():
+    assert alarm_text(0, WARNING_BITS, "Warning", "No Warnings") == "No Warnings - 0000"
+    assert alarm_text(0x0011, PROTECTION_BITS, "Protection", "None") == (
+        "Protection: 0001 - Pack Over Voltage | Protection: 0010 - Charge Over Current"
+    )
+    assert alarm_text(0x8000, WARNING_BITS, "Warning", "None") == "Warning: 8000 - UNKNOWN"
+
+
+def test_pack_health_quarantine_and_backoff():
+    health = PackHealth()
+    assert health.record_failure(0, 3, 10, 40) == PACK_HEALTHY
+    assert health.state == PACK_SUSPECT and health.should_poll(0)
+    health.record_failure(1, 3, 10, 40)
+    health.record_failure(2, 3, 10, 40)
+    assert health.state == PACK_QUARANTINED
+    assert not health.should_poll(11) and health.should_poll(12)
+    # Every failed probe doubles the back off, up to its maximum
+    health.record_failure(12, 3, 10, 40)
+    assert health.next_probe == 32
+    health.record_failure(32, 3, 10, 40)
+    health.record_failure(72, 3, 10, 40)
+    assert health.next_probe == 112
+    assert health.record_success() == PACK_QUARANTINED
+    assert (health.state, health.failures, health.backoff) == (PACK_HEALTHY, 0, 0)
+
+
+def test_scheduler_staggers_slow_blocks():
+    scheduler = PollScheduler({"FAST" : (1, 0), "CELL" : (5, 1)}, None)
+    bmsIds = [16, 1, 2, 3, 4]
+    reads = {bmsId : [] for bmsId in bmsIds}
+    for cycle in range(11):
+        plan = scheduler.plan(bmsIds)
+        assert all("FAST" in plan[bmsId] for bmsId in bmsIds)
+        # From the second cycle on one pack per cycle: five packs on a five cycle interval
+        assert sum("CELL" in plan[bmsId] for bmsId in bmsIds) == (cycle > 0)
+        for bmsId in bmsIds:
+            if "CELL" in plan[bmsId]:
+                reads[bmsId].append(cycle)
+    assert all(len(cycles) == 2 and cycles[1] - cycles[0] == 5 for cycles in reads.values())
+
+
+def test_scheduler_budget_defers_by_priority():
+    scheduler = PollScheduler({"HW" : (3, 2), "CONFIG" : (3, 3)}, 1)
+    plans = [scheduler.plan([16])[16] for cycle in range(4)]
+    # Both come due on the second cycle, the budget takes HW first and CONFIG stays due
+    assert plans == [[], ["HW"], ["CONFIG"], []]
+
+
+@pytest.fixture
+def emulator():
+    chain = EG4LLEmulator([16, 1, 2], baud=9600)
+    chain.start()
+    yield chain
+    chain.stop()
+
+
+def start_driver(port, tmp_path, **options):
+    battery = EG4_LL(port, 9600, 0)
+    battery.batteryPackId = [16, 1, 2]
+    battery.state_file = str(tmp_path / "state.json")
+    battery.topology_file = str(tmp_path / "topology.json")
+    for name, value in options.items():
+        setattr(battery, name, value)
+    assert battery.test_connection() and battery.get_settings()
+    return battery
+
+
+def test_warm_start_with_status_logger(emulator, tmp_path, caplog):
+    cold = start_driver(emulator.port, tmp_path)
+    assert cold.refresh_data()
+    cold.bus.close()
+    caplog.set_level(logging.INFO, logger="SerialBattery")
+    warm = start_driver(emulator.port, tmp_path, statuslogger=True)
+    assert warm.verify_pending and set(warm.stale_packs) == {1, 2}
+    assert "warm start, unverified" in caplog.text
+    assert warm.refresh_data()
+    assert not warm.verify_pending and warm.stale_packs == {}
+    warm.bus.close()
+
+
+def test_garbled_replies_count_as_bad_crc():
+    chain = EG4LLEmulator([16], baud=9600, bad_crc=1.0)
+    battery = EG4_LL(chain.start(), 9600, 0)
+    try:
+        assert battery.read_serial_data_eg4_ll(battery.generate_command(16, "CELL"), probe=True) is False
+        assert battery.get_bus_metrics()["commands"]["16/CELL"]["bad_crc"] == 1
+        assert battery.get_bus_metrics()["commands"]["16/CELL"]["timeouts"] == 0
+    finally:
+        battery.bus.close()
+        chain.stop()
+
+
+def test_config_is_not_read_by_default(emulator, tmp_path):
+    battery = start_driver(emulator.port, tmp_path)
+    assert battery.refresh_data()
+    assert not [name for name in battery.get_bus_metrics()["commands"] if name.endswith("/CONFIG")]
+    assert battery.get_pack_config(16) is None
+    battery.bus.close()
+
+
+def test_config_change_updates_cached_balancing(emulator, tmp_path):
+    battery = start_driver(emulator.port, tmp_path, config_balancer_thresholds=True)
+    assert battery.get_pack_config(16).balancer_voltage == 3.40
+    assert battery.get_balancing() == 0
+    # Same cells, no new frame: only the balancer thresholds move below the cell voltages
+    for bmsId, emulated in emulator.packs.items():
+        emulated.write_config({"balancer_voltage" : 2.6, "balancer_delta" : 0.001})
+        assert battery.read_bms_config(bmsId)
+        battery.apply_config(battery.battery_stats[bmsId], bmsId)
+    assert battery.get_balancing() != 0
+    battery.bus.close()
+
+
+@pytest.mark.parametrize("mapping", [False, True])
+def test_extra_chain_has_its_own_pack_ids(tmp_path, monkeypatch, mapping):
+    first = EG4LLEmulator([16, 1], baud=9600, seed=1)
+    second = EG4LLEmulator([16, 1, 2], baud=0, seed=2)
+    first.start()
+    second.start()
+    monkeypatch.setattr(EG4_LL, "extra_ports", {second.port : [16, 1, 2]} if mapping else (second.port,))
+    monkeypatch.setattr(EG4_LL, "state_file", str(tmp_path / "state.json"))
+    monkeypatch.setattr(EG4_LL, "topology_file", str(tmp_path / "topology.json"))
+    monkeypatch.setattr(EG4_LL, "discovery_timeout", 0.05)
+    battery = EG4_LL(first.port, 9600, 0)
+    battery.batteryPackId = [16, 1]
+    try:
+        assert battery.test_connection() and battery.get_settings()
+        assert [chain.batteryPackId for chain in battery.chains] == [[16, 1, 2]]
+        assert battery.chain_pack_ids() == [32, 17, 18]
+        assert battery.refresh_data()
+        assert sorted(battery.battery_stats) == [1, 16, 17, 18, 32]
+    finally:
+        battery.stop_poller()
+        for chain in [battery] + battery.chains:
+            chain.bus.close()
+        first.stop()
+        second.stop()
+
+
+def test_wide_read_only_rejected_by_an_exception(emulator, tmp_path, monkeypatch):
+    # HW and CELL both due every cycle, so every sweep can use the wide read
+    monkeypatch.setattr(EG4_LL, "POLL_SCHEDULE", {"CELL" : (1, 0), "HW" : (1, 1)})
+    battery = start_driver(emulator.port, tmp_path, wide_read=True)
+    assert battery.refresh_data()
+    commands = battery.get_bus_metrics()["commands"]
+    assert commands["1/WIDE"]["requests"] == 2 and "1/HW" not in commands and "1/CELL" not in commands
+    emulator.dead_ids = (1,)
+    assert battery.read_pack_details(1, probe=True) is False
+    assert battery.wide_read_rejected == set()
+    # A BMS that answers the wide read with an exception gets the separate reads from then on
+    battery.commands[2]["WIDE"] = build_command(2, MODBUS_READ_HOLDING, 0x0100, 0x10)
+    assert battery.read_pack_details(2) is not False
+    assert battery.wide_read_rejected == {2}
+    battery.bus.close()
+
+
+def test_diff_status_format_never_dumps_text(emulator, tmp_path, caplog):
+    caplog.set_level(logging.INFO, logger="SerialBattery")
+    battery = start_driver(emulator.port, tmp_path, statuslogger=True, status_format="diff")
+    assert battery.refresh_data()
+    assert "EG4_LL status {" in caplog.text
+    assert "Cell Stats" not in caplog.text and "=== BMS ID-" not in caplog.text
+    battery.bus.close()